@@ -1,10 +1,14 @@
-import json
 import time
 import random
 import argparse
 
 import streamlit as st
 
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+from utilities.records import Clique
+from utilities.release_table import load_release_table, join_releases
+
 st.set_page_config(page_title="Discogs-VI-YT", page_icon=":loud_sound:", layout="wide")
 
 #### Load Data ####
@@ -35,11 +39,15 @@ def read_cliques(demo_json: str):
     """
 
     t0 = time.monotonic()
+    # The release table of normalized cliques, if there is one
+    releases = load_release_table(demo_json)
     cliques, n_versions, titles = [], [], []
-    with open(demo_json, encoding="utf-8") as in_f:
+    with open_jsonl(demo_json) as in_f:
         for jsonline in in_f:
-            # Load the clique
-            clique = json.loads(jsonline)
+            # Load the clique, with the release fields of its tracks
+            clique = Clique.from_dict(loads(jsonline), releases)
+            if releases is not None:
+                join_releases(clique)
             cliques.append(clique)
             # Get the number of versions per clique for the slider
             n_versions.append(len(clique["versions"]))
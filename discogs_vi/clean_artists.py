@@ -3,12 +3,29 @@ the output in a line-delimited JSON file where each line corresponds to a
 particular release."""
 
 import os
-import json
+import sys
 import time
+from array import array
+from operator import eq
+from itertools import repeat
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+import numpy as np
+
 from variables import NO_ARTIST
 
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utilities.jsonl_io import open_jsonl, add_suffix
+from utilities.json_codec import loads, dumps
+from utilities.metrics import StageMetrics
+from utilities.artist_graph import get_graph_dir, artists_to_graph, save_artist_graph
+
+# Fields with the ids of related artists
+RELATION_KEYS = ("aliases", "members", "groups")
+
+# Approximate number of artist pairs per batch when resolving the name variations
+NV_BATCH_PAIRS = 2**22
+
 
 def clean_artist(artist, diff):
     """Removes artists with bad quality annotations and fixes the keys."""
@@ -54,40 +71,125 @@ def clean_artist(artist, diff):
     return artist
 
 
-def get_all_name_variations(artist_id, artists_dict, name_to_id):
-    """Returns a set of all the name variations of the artist."""
-
-    if "namevariations" not in artists_dict[artist_id]:
-        return []
-
-    namevar_ids = set()
-    for namevar in artists_dict[artist_id]["namevariations"]:
-        # Use the reverse lookup dictionary
-        if namevar in name_to_id:
-            namevar_ids.add(name_to_id[namevar])
-
-    # namevar_ids.add(artist_id) # TODO: Is this necessary?
-
-    # Collect the variations of the variations
-    namevar_var_ids = set()
-    for _id in namevar_ids:
-        if "namevariations" in artists_dict[_id]:
-            for namevar in artists_dict[_id]["namevariations"]:
-                # Use the reverse lookup dictionary
-                if namevar in name_to_id:
-                    namevar_var_ids.add(name_to_id[namevar])
-
-    return list(namevar_ids.union(namevar_var_ids))
+def expand_ranges(starts, ends):
+    """Returns the concatenation of the ranges starts[i]:ends[i] and, for each
+    of its values, the index i of its range."""
+
+    counts = ends - starts
+    range_index = np.repeat(np.arange(len(starts)), counts)
+    # Position of each value in its range
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return starts[range_index] + offsets, range_index
+
+
+def unique_pairs(rows, targets, n_rows):
+    """Keeps the first occurrence of each (row, target) pair, grouped by row
+    in ascending order."""
+
+    _, first = np.unique(rows.astype(np.int64) * n_rows + targets, return_index=True)
+    first.sort()
+    first = first[np.argsort(rows[first], kind="stable")]
+    return rows[first], targets[first]
+
+
+def resolve_name_variations(names, nv_rows, nv_names, shared_names=False):
+    """Finds the artists with the name variations of each artist and the name
+    variations of those, as a batched join on the name hashes confirmed on the
+    strings. names are the names of the artists by row and (nv_rows, nv_names)
+    the row of an artist and one of its name variations, in the order of the
+    rows. A name can be shared by several artists: only the last one is used,
+    or all of them with shared_names. Returns CSR offsets and the rows of the
+    resolved artists, in the order they are found, and the number of artists
+    that have the name of another artist."""
+
+    n_rows = len(names)
+
+    # Sorted name hashes with the rows of the artists
+    name_hashes = np.fromiter(map(hash, names), dtype=np.int64, count=n_rows)
+    name_rows = np.argsort(name_hashes, kind="stable").astype(np.int32)
+    name_hashes = name_hashes[name_rows]
+    n_shared = np.count_nonzero(np.diff(name_hashes) == 0)
+
+    # First level: the artists with the name variations of each artist
+    nv_hashes = np.fromiter(map(hash, nv_names), dtype=np.int64, count=len(nv_names))
+    starts = np.searchsorted(name_hashes, nv_hashes, "left")
+    ends = np.searchsorted(name_hashes, nv_hashes, "right")
+    del name_hashes, nv_hashes
+    positions, range_index = expand_ranges(starts, ends)
+    # Only the artists with the same name, not just the same hash
+    same = np.fromiter(
+        map(
+            eq,
+            map(names.__getitem__, name_rows[positions].tolist()),
+            map(nv_names.__getitem__, range_index.tolist()),
+        ),
+        dtype=bool,
+        count=len(positions),
+    )
+    positions, range_index = positions[same], range_index[same]
+    if not shared_names:
+        # The last artist with the name, the rows are sorted within a hash
+        last = np.ones(len(range_index), dtype=bool)
+        last[:-1] = range_index[1:] != range_index[:-1]
+        positions, range_index = positions[last], range_index[last]
+    rows1, targets1 = unique_pairs(nv_rows[range_index], name_rows[positions], n_rows)
+    del name_rows, positions, range_index
+    offsets1 = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows1, minlength=n_rows), out=offsets1[1:])
+
+    # Second level: the first level of each artist found in the first level.
+    # The rows are joined in batches of about NV_BATCH_PAIRS pairs to bound
+    # the memory.
+    degrees = np.diff(offsets1)
+    costs = np.zeros(n_rows + 1, dtype=np.int64)
+    row_costs = np.bincount(rows1, weights=degrees[targets1] + 1, minlength=n_rows)
+    np.cumsum(row_costs.astype(np.int64), out=costs[1:])
+    bounds = np.searchsorted(costs, np.arange(0, costs[-1], NV_BATCH_PAIRS), "right")
+    bounds = np.unique(np.concatenate([[0], bounds - 1, [n_rows]]))
+
+    counts, targets = [], []
+    for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        batch_rows = rows1[offsets1[start] : offsets1[end]]
+        batch_targets = targets1[offsets1[start] : offsets1[end]]
+        positions, range_index = expand_ranges(
+            offsets1[batch_targets], offsets1[batch_targets + 1]
+        )
+        batch_rows, batch_targets = unique_pairs(
+            np.concatenate([batch_rows, batch_rows[range_index]]),
+            np.concatenate([batch_targets, targets1[positions]]),
+            n_rows,
+        )
+        counts.append(np.bincount(batch_rows - start, minlength=end - start))
+        targets.append(batch_targets)
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=offsets[1:])
+        targets = np.concatenate(targets)
+    return offsets, targets, n_shared
+
+
+def compact_artist(artist, layouts):
+    """Returns the artist dictionary as a (keys, values) tuple, which takes
+    much less memory. The keys tuple is shared by all the artists with the
+    same keys in the same order. The ids are interned in place since they are
+    repeated in the relations of other artists."""
+
+    artist["id"] = sys.intern(artist["id"])
+    for key in RELATION_KEYS:
+        if key in artist:
+            artist[key] = tuple(map(sys.intern, artist[key]))
+    keys = tuple(artist)
+    return layouts.setdefault(keys, keys), tuple(artist.values())
 
 
-def main(json_file, output_dir=None):
+def main(json_file, output_dir=None, shared_names=False):
 
     # Write next to the json file if no output_dir is specified
     if output_dir is None:
         output_dir = os.path.dirname(os.path.normpath(json_file))
 
     # The output file will have the same name as the xml file but with .json extension
-    clean_json_file = f"{json_file}.clean"
+    clean_json_file = add_suffix(json_file, ".clean")
     # Ask the user whether to delete the existing file
     if os.path.isfile(clean_json_file):
         if input(f"{clean_json_file} exists. Remove?[Y/n] ") == "n":
@@ -95,65 +197,80 @@ def main(json_file, output_dir=None):
 
     start_time = time.monotonic()
 
-    # Load all the artists from the json file
+    # Load all the artists from the json file in a compact form, they are
+    # cleaned when all the artist ids are known
     print("Loading the artists...")
-    artist_ids_with_releases, all_artist_ids = set(), set()
-    with open(json_file, encoding="utf-8") as infile:
+    processed = 0
+    artists, layouts = {}, {}
+    # The row of each name variation and the variation, shared with the artist
+    nv_rows, nv_names = array("i"), []
+    all_artist_ids = set()
+    metrics = StageMetrics("clean_artists", json_file)
+    with open_jsonl(json_file) as infile:
+        metrics.in_f = infile
         for jsonline in infile:
             # Load the artist information
-            artist_dict = json.loads(jsonline)
-
-            # Add the artist's ID to the set of artists with releases
-            artist_ids_with_releases.update({artist_dict["id"]})
+            artist = loads(jsonline)
+            assert artist["id"] not in artists, f"Duplicate artist id {artist['id']}"
+            if "namevariations" in artist:
+                nv_rows.extend(repeat(len(artists), len(artist["namevariations"])))
+                nv_names.extend(artist["namevariations"])
+            artists[artist["id"]] = compact_artist(artist, layouts)
 
             # Add the artist and all its aliases, members and groups
             # to the set of all artists
-            all_artist_ids.update({artist_dict["id"]})
-            all_artist_ids.update(artist_dict.get("aliases", {}))
-            all_artist_ids.update(artist_dict.get("members", {}))
-            all_artist_ids.update(artist_dict.get("groups", {}))
-    diff = all_artist_ids - artist_ids_with_releases
-    print(f"Found {len(all_artist_ids):>9,} artists in total")
-    print(f"Found {len(artist_ids_with_releases):>9,} artists with releases")
-    print(f"Found {len(diff):>9,} artists without releases")
-
-    # Load all the artists from the json file and clean them
-    print("Cleaning the artists...")
-    processed = 0
-    artists_dict = {}
-    with open(json_file, encoding="utf-8") as infile:
-        for jsonline in infile:
-            # Load the artist information
-            artist_dict = json.loads(jsonline)
-
-            # Clean the artist
-            artist = clean_artist(artist_dict, diff)
-
-            # Add the cleaned artist to the dictionary
-            artists_dict[artist["id"]] = artist
+            all_artist_ids.add(artist["id"])
+            for key in RELATION_KEYS:
+                all_artist_ids.update(artist.get(key, ()))
 
             processed += 1
+            metrics.step()
             if not processed % 100000:
                 print(f"Processed {processed:>10,} artists")
     print(f"Processed {processed:>10,} artists")
 
-    print('Adding "namevariations_id" to the artists...')
-    start_time = time.monotonic()
-    # Create a reverse lookup dictionary
-    name_to_id = {v["name"]: k for k, v in artists_dict.items()}
+    # The artists of the file are the artists with releases
+    diff = all_artist_ids - artists.keys()
+    print(f"Found {len(all_artist_ids):>9,} artists in total")
+    print(f"Found {len(artists):>9,} artists with releases")
+    print(f"Found {len(diff):>9,} artists without releases")
+
+    print("Resolving the name variations...")
+    nv_offsets, nv_targets, n_shared = resolve_name_variations(
+        [values[keys.index("name")] for keys, values in artists.values()],
+        np.frombuffer(nv_rows, dtype=np.int32),
+        nv_names,
+        shared_names,
+    )
+    del nv_rows, nv_names
+    print(f"Found {n_shared:>9,} artists with the name of another artist")
+    artist_ids = list(artists)
+
+    print('Cleaning the artists and adding "namevariations_id"...')
 
-    with open(clean_json_file, "w", encoding="utf-8") as json_f_clean:
-        for artist_id in artists_dict:
+    def cleaned_artists(json_f_clean):
+        """Writes the cleaned artists and yields them for the artist graph."""
+
+        for row, (keys, values) in enumerate(artists.values()):
+            # Clean the artist
+            artist = clean_artist(dict(zip(keys, values)), diff)
             # Add the name variations to the dictionary
-            name_variations = get_all_name_variations(
-                artist_id, artists_dict, name_to_id
-            )
-            if name_variations:
-                artists_dict[artist_id]["namevariations_id"] = name_variations
+            targets = nv_targets[nv_offsets[row] : nv_offsets[row + 1]]
+            if len(targets):
+                artist["namevariations_id"] = [artist_ids[t] for t in targets.tolist()]
             # Write the cleaned and modified artist to the output file
-            json_f_clean.write(
-                json.dumps(artists_dict[artist_id], ensure_ascii=False) + "\n"
-            )
+            json_f_clean.write(dumps(artist) + "\n")
+            yield artist
+
+    with open_jsonl(clean_json_file, "w") as json_f_clean:
+        metrics.out_f = json_f_clean
+        graph = artists_to_graph(cleaned_artists(json_f_clean))
+        metrics.close()
+
+    # The relations as arrays, the next stages load them instead of the json file
+    graph_dir = get_graph_dir(clean_json_file)
+    print(f"Saving the artist graph to {graph_dir}")
+    save_artist_graph(graph, graph_dir, clean_json_file)
     print(
         "Processing time: "
         f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-start_time))}"
@@ -177,10 +294,17 @@ if __name__ == "__main__":
         "If not specified, the output file will be stored"
         "next to the input file.",
     )
+    parser.add_argument(
+        "--shared-names",
+        "-s",
+        action="store_true",
+        help="Resolve a name variation to all the artists with that name. By "
+        "default only the last artist of the file with that name is used.",
+    )
     args = parser.parse_args()
 
     # Read the input xml, process and write to json_file
-    main(args.json_file, args.output_dir)
+    main(args.json_file, args.output_dir, args.shared_names)
 
     #############
     print("Done!")
@@ -2,10 +2,12 @@
 metadata relevant for building the DiscoTubeVersions dataset"""
 
 import os.path
+import re
 import json
 import sys
 import time
 import argparse
+from collections import Counter
 
 from variables import (
     WRITTEN,
@@ -16,8 +18,39 @@ from variables import (
     TAXONOMY_PATH,
 )
 
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utilities.jsonl_io import open_jsonl, add_suffix
+from utilities.json_codec import loads, dumps
+from utilities.metrics import StageMetrics
+from utilities.parallel import imap_chunks, progress_steps
+from utilities.artist_graph import load_valid_artist_graph
+
 GENRE_TREE_ERRORS = 0
 
+# Number of releases skipped by clean_release for each reason
+DROPS = Counter()
+
+# A release is only kept if one of its tracks has a role containing WRITTEN, so
+# its line must contain WRITTEN in some case. JSON encoders do not escape ASCII
+# letters, and IGNORECASE also matches any character whose lower() is in WRITTEN
+WRITTEN_PATTERN = re.compile(re.escape(WRITTEN), re.IGNORECASE)
+# How the role is written in most releases, found faster than with the pattern
+WRITTEN_TITLE = WRITTEN.title()
+
+# Releases rejected by the pre-filter that clean_release would have kept, only
+# counted with verify_prefilter
+PREFILTER_ERRORS = 0
+
+# Kinds of extraartist roles, see RoleClassifier
+WRITER, FEATURING = "writer", "featuring"
+
+# Matches WRITTEN and FEAT, none of them overlaps with another
+ROLE_PATTERN = re.compile("|".join(map(re.escape, [WRITTEN] + FEAT)))
+
+# Set in each worker process by init_worker
+worker_artist_ids, worker_genre_tree = None, None
+worker_prefilter, worker_verify = True, False
+
 
 def extract_style(release, genre_tree):
     # Find parent genres for styles following Discogs genre tree.
@@ -52,6 +85,27 @@ def extract_format(release):
     release["formats"] = [f["@name"] for f in release["formats"]]
 
 
+class RoleClassifier(dict):
+    """Maps role strings to WRITER if they contain WRITTEN, to FEATURING if
+    they contain one of FEAT and to None otherwise, ignoring case. Each
+    distinct role is classified once, with a single scan, and then looked up.
+    There are few distinct roles but many credits."""
+
+    def __missing__(self, role):
+        matches = ROLE_PATTERN.findall(role.lower())
+        if WRITTEN in matches:
+            kind = WRITER
+        elif matches:
+            kind = FEATURING
+        else:
+            kind = None
+        self[role] = kind
+        return kind
+
+
+ROLES = RoleClassifier()
+
+
 def _get_unique_artists(obj, all_ids, unique_ids):
     """obj can be a release or track dict."""
 
@@ -72,18 +126,14 @@ def _get_writers_feats(obj):
     for ea in obj["extraartists"]:
         # Only include extraartists with roles
         if "role" in ea:
-            role = ea["role"].lower()
             # Only include roles with WRITTEN or FEAT information
-            if WRITTEN in role:
+            kind = ROLES[ea["role"]]
+            if kind is WRITER:
                 writers.append(ea)
-            else:
-                # Check if the role contains FEAT information
-                # This can be usefull for version identification later
-                # but we do not use this information for clique or version
-                for f in FEAT:
-                    if f in role:
-                        feats.append(ea)
-                        break
+            # FEAT information can be usefull for version identification later
+            # but we do not use this information for clique or version
+            elif kind is FEATURING:
+                feats.append(ea)
     return writers, feats
 
 
@@ -125,9 +175,10 @@ def _clean_writers_feats(writers, feats, all_artist_ids):
     # TODO? Remove any writer that is also listed as a feat??
 
     # Remove featuring artists that are excluded
-    feats = [f for f in feats if f["id"] not in EXCLUDE_ARTISTS]
+    key = all_artist_ids.key
+    feats = [f for f in feats if key(f["id"]) not in all_artist_ids.excluded]
     # Keep featuring artists are not in the artist list
-    feats = [f for f in feats if f["id"] in all_artist_ids]
+    feats = [f for f in feats if key(f["id"]) in all_artist_ids]
 
     return writers, feats
 
@@ -217,12 +268,238 @@ def clean_master_id(release):
         release["master_id"] = ""
 
 
-def main(input_json, artists_json, output_json=None):
+def load_genre_tree():
+    """Loads the Discogs genre tree as a genre -> styles dictionary."""
+
+    genre_tree_json = json.load(open(os.path.join(sys.path[0], TAXONOMY_PATH)))
+    genre_tree = {}
+    for genre in genre_tree_json:
+        genre_tree[genre["name"]] = genre["styles"]
+    # Decode javascript unicode strings.
+    # Converting to json and back appears to be the easiest way to do that.
+    return json.loads(json.dumps(genre_tree))
+
+
+class ArtistIds(set):
+    """Set of artist ids, as strings or with int_ids as ints, which take less
+    memory and are faster to hash. key converts the string ids of the releases
+    to the type of the set and excluded holds EXCLUDE_ARTISTS with that type.
+    The ids in the releases are not modified."""
+
+    def __init__(self, ids=(), int_ids=False):
+        self.key = int if int_ids else str
+        self.excluded = frozenset(map(self.key, EXCLUDE_ARTISTS))
+        super().__init__(map(self.key, ids))
+
+    def __reduce__(self):
+        # Pickled with the type of the ids, e.g. for the workers of spawn or
+        # forkserver pools, which receive the set through pickle
+        return (type(self), (list(self), self.key is int))
+
+
+def load_artist_ids(artists_json, int_ids=False):
+    """Loads all the artist ids from the line-delimited artists json file, or
+    from the artist graph that clean_artists.py saves next to it."""
+
+    graph = load_valid_artist_graph(artists_json)
+    if graph is not None:
+        return ArtistIds(graph.ids.tolist(), int_ids)
+
+    all_artist_ids = ArtistIds(int_ids=int_ids)
+    key = all_artist_ids.key
+    with open_jsonl(artists_json) as infile:
+        for jsonline in infile:
+            # Load the artist information
+            artist_dict = loads(jsonline)
+            # Add the artist's ID to the set of artists with releases
+            all_artist_ids.add(key(artist_dict["id"]))
+    return all_artist_ids
+
+
+def clean_release(release, all_artist_ids, genre_tree):
+    """Cleans the release in place. Returns False if the release should be
+    skipped. all_artist_ids is an ArtistIds set."""
+
+    # Skip releases with generic artists
+    key = all_artist_ids.key
+    r_artists = set([key(a["id"]) for a in release["artists"]])
+    if len(r_artists.intersection(all_artist_ids.excluded)) > 0:
+        DROPS["excluded_artists"] += 1
+        return False
+    # Skip releases with artists not in the artist list
+    # This is a discogs bug
+    if len(r_artists.intersection(all_artist_ids)) != len(r_artists):
+        DROPS["unknown_artists"] += 1
+        return False
+    # Exclude releases with certain genres
+    if len(set(release["genres"]).intersection(EXCLUDE_GENRES)) > 0:
+        DROPS["excluded_genres"] += 1
+        return False
+
+    # Clean the release in an efficient way
+    clean_tracklist_extraartists(release, all_artist_ids)
+    if len(release["tracklist"]) == 0:
+        DROPS["no_written_tracks"] += 1
+        return False
+    clean_release_artists_duplicates(release)
+    if len(release["artists"]) > N_MAX_ARTISTS:
+        DROPS["too_many_artists"] += 1
+        return False
+    clean_tracklist_artists_duplicates(release)
+    if len(release["tracklist"]) == 0:
+        DROPS["no_tracks"] += 1
+        return False
+    clean_release_extraartists(release, all_artist_ids)
+
+    # Extract the relevant metadata
+    extract_year(release)
+    extract_style(release, genre_tree)
+    extract_videos(release)
+    extract_format(release)
+    clean_master_id(release)
+    return True
+
+
+def may_be_kept(jsonline):
+    """Pre-filter on the raw line of a release. Returns False if the release
+    can not survive clean_release, i.e. no track can have a writer, so that it
+    can be dropped without decoding it. Returns True for the other releases,
+    which may still be dropped by clean_release."""
+    return WRITTEN_TITLE in jsonline or WRITTEN_PATTERN.search(jsonline) is not None
+
+
+def clean_line(jsonline, all_artist_ids, genre_tree, prefilter=True, verify=False):
+    """Decodes and cleans a release line. Returns the clean release or None if
+    it is skipped. With prefilter, the lines rejected by may_be_kept are not
+    decoded and are counted as prefiltered in DROPS. With verify, with or
+    without prefilter, they are decoded and cleaned anyway, and those that
+    clean_release keeps are counted in PREFILTER_ERRORS, so DROPS and the
+    output are those without prefilter."""
+
+    global PREFILTER_ERRORS
+
+    if prefilter and not verify and not may_be_kept(jsonline):
+        DROPS["prefiltered"] += 1
+        return None
+    release = loads(jsonline)
+    if not clean_release(release, all_artist_ids, genre_tree):
+        return None
+    if verify and not may_be_kept(jsonline):
+        PREFILTER_ERRORS += 1
+        print(f"The pre-filter would drop release {release['id']}")
+    return release
+
+
+def init_worker(all_artist_ids, genre_tree, prefilter=True, verify=False):
+    """Keeps the artist ids, the genre tree and the pre-filter options in the
+    worker process, see imap_chunks."""
+
+    global worker_artist_ids
+    global worker_genre_tree
+    global worker_prefilter
+    global worker_verify
+
+    worker_artist_ids, worker_genre_tree = all_artist_ids, genre_tree
+    worker_prefilter, worker_verify = prefilter, verify
+
+
+def clean_chunk(lines):
+    """Cleans a chunk of release lines in a worker. Returns the output lines,
+    the number of releases, of clean releases and of their tracks, and the
+    GENRE_TREE_ERRORS, PREFILTER_ERRORS and DROPS of the chunk."""
+
+    global GENRE_TREE_ERRORS
+    global PREFILTER_ERRORS
+
+    # Count the errors and the drops of this chunk only
+    GENRE_TREE_ERRORS, PREFILTER_ERRORS = 0, 0
+    DROPS.clear()
+    output, r_success, t_total = [], 0, 0
+    for jsonline in lines:
+        release = clean_line(
+            jsonline,
+            worker_artist_ids,
+            worker_genre_tree,
+            worker_prefilter,
+            worker_verify,
+        )
+        if release is None:
+            continue
+        output.append(dumps(release) + "\n")
+        r_success += 1
+        t_total += len(release["tracklist"])
+    return (
+        "".join(output),
+        len(lines),
+        r_success,
+        t_total,
+        GENRE_TREE_ERRORS,
+        PREFILTER_ERRORS,
+        DROPS,
+    )
+
+
+def clean_in_chunks(
+    in_f,
+    out_f,
+    all_artist_ids,
+    genre_tree,
+    workers,
+    metrics,
+    prefilter=True,
+    verify=False,
+    input_json=None,
+):
+    """Cleans the releases of in_f with a pool of workers, in chunks of
+    lines, and writes them to out_f in the input order. If input_json, the
+    path of in_f, can be split, the workers read the chunks from it. Returns the
+    number of releases, clean releases and their tracks. GENRE_TREE_ERRORS,
+    PREFILTER_ERRORS and DROPS are updated as if the releases were cleaned in
+    this process."""
+
+    global GENRE_TREE_ERRORS
+    global PREFILTER_ERRORS
+
+    r_total, r_success, t_total = 0, 0, 0
+    initargs = (all_artist_ids, genre_tree, prefilter, verify)
+    for (
+        output,
+        n,
+        n_success,
+        n_tracks,
+        errors,
+        prefilter_errors,
+        drops,
+    ) in imap_chunks(
+        in_f, clean_chunk, workers, init_worker, initargs, input_json, metrics
+    ):
+        out_f.write(output)
+        for n_processed in progress_steps(r_total, n):
+            print(f"Processed {n_processed:>10,} releases")
+        r_total += n
+        r_success += n_success
+        t_total += n_tracks
+        GENRE_TREE_ERRORS += errors
+        PREFILTER_ERRORS += prefilter_errors
+        DROPS.update(drops)
+        metrics.step(n)
+    return r_total, r_success, t_total
+
+
+def main(
+    input_json,
+    artists_json,
+    output_json=None,
+    int_ids=False,
+    workers=1,
+    prefilter=True,
+    verify_prefilter=False,
+):
     """Clean each release and export the cleaned version"""
 
     # Determine the output path if not provided
     if output_json is None:
-        output_json = input_json + ".clean"
+        output_json = add_suffix(input_json, ".clean")
         print(f"Releases will be saved to: {output_json}")
     # Create the parent directory if it does not exist
     output_dir = os.path.dirname(output_json)
@@ -235,82 +512,64 @@ def main(input_json, artists_json, output_json=None):
             output_json = input(f"New .json path?\n")
 
     # Discogs genre tree.
-    genre_tree_json = json.load(open(os.path.join(sys.path[0], TAXONOMY_PATH)))
-    genre_tree = {}
-    for genre in genre_tree_json:
-        genre_tree[genre["name"]] = genre["styles"]
-    # Decode javascript unicode strings.
-    # Converting to json and back appears to be the easiest way to do that.
-    genre_tree = json.loads(json.dumps(genre_tree))
+    genre_tree = load_genre_tree()
 
     # Load all the artist ids from the json file
-    all_artist_ids = set()
-    with open(artists_json, encoding="utf-8") as infile:
-        for jsonline in infile:
-            # Load the artist information
-            artist_dict = json.loads(jsonline)
-            # Add the artist's ID to the set of artists with releases
-            all_artist_ids.update({artist_dict["id"]})
+    all_artist_ids = load_artist_ids(artists_json, int_ids)
 
     # Clean the releases
     start_time = time.monotonic()
     print("Cleaning the releases...")
-    with open(input_json, encoding="utf-8") as in_f, open(
-        output_json, "w", encoding="utf-8"
-    ) as out_f:
+    with open_jsonl(input_json) as in_f, open_jsonl(output_json, "w") as out_f:
+        metrics = StageMetrics(
+            "clean_releases", input_json, in_f, out_f, {"clean_release": DROPS}
+        )
         r_total, r_success, t_total = 0, 0, 0
-        for jsonline in in_f:
-            # Load the release
-            release = json.loads(jsonline)
-
-            # Print progress
-            r_total += 1
-            if not r_total % 500000:
-                print(f"Processed {r_total:>10,} releases")
-
-            # Skip releases with generic artists
-            r_artists = set([a["id"] for a in release["artists"]])
-            if len(r_artists.intersection(EXCLUDE_ARTISTS)) > 0:
-                continue
-            # Skip releases with artists not in the artist list
-            # This is a discogs bug
-            if len(r_artists.intersection(all_artist_ids)) != len(r_artists):
-                continue
-            # Exclude releases with certain genres
-            if len(set(release["genres"]).intersection(EXCLUDE_GENRES)) > 0:
-                continue
-
-            # Clean the release in an efficient way
-            clean_tracklist_extraartists(release, all_artist_ids)
-            if len(release["tracklist"]) == 0:
-                continue
-            clean_release_artists_duplicates(release)
-            if len(release["artists"]) > N_MAX_ARTISTS:
-                continue
-            clean_tracklist_artists_duplicates(release)
-            if len(release["tracklist"]) == 0:
-                continue
-            clean_release_extraartists(release, all_artist_ids)
-
-            # Extract the relevant metadata
-            extract_year(release)
-            extract_style(release, genre_tree)
-            extract_videos(release)
-            extract_format(release)
-            clean_master_id(release)
-
-            # Write the cleaned release
-            out_f.write(json.dumps(release, ensure_ascii=False) + "\n")
-            r_success += 1
-            t_total += len(release["tracklist"])
+        if workers > 1:
+            r_total, r_success, t_total = clean_in_chunks(
+                in_f,
+                out_f,
+                all_artist_ids,
+                genre_tree,
+                workers,
+                metrics,
+                prefilter,
+                verify_prefilter,
+                input_json,
+            )
+        else:
+            # With a single worker, clean the releases in this process
+            for jsonline in in_f:
+                # Print progress
+                r_total += 1
+                metrics.step()
+                if not r_total % 500000:
+                    print(f"Processed {r_total:>10,} releases")
+
+                # Load and clean the release, or skip it
+                release = clean_line(
+                    jsonline, all_artist_ids, genre_tree, prefilter, verify_prefilter
+                )
+                if release is None:
+                    continue
+
+                # Write the cleaned release
+                out_f.write(dumps(release) + "\n")
+                r_success += 1
+                t_total += len(release["tracklist"])
+        metrics.close()
     print(f"{r_total:>10,} releases are processed in total.")
     print(f"{r_success:>10,} releases remain after cleaning.")
     print(f"{t_total:>10,} tracks remain after cleaning.")
     print(f"{GENRE_TREE_ERRORS:>10,} genre-style matching errors found.")
+    if verify_prefilter:
+        print(f"{PREFILTER_ERRORS:>10,} kept releases rejected by the pre-filter.")
     print(
         "Total processing time: "
         f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-start_time))}"
     )
+    if PREFILTER_ERRORS:
+        sys.exit(f"The pre-filter rejects {PREFILTER_ERRORS:,} releases that are kept.")
 
 
 if __name__ == "__main__":
@@ -330,10 +589,46 @@ if __name__ == "__main__":
         help="Output line-delimited JSON file with clean metadata."
         " Leave empty for auto.",
     )
+    parser.add_argument(
+        "--int-ids",
+        "-i",
+        action="store_true",
+        help="Keep the artist ids as integers in memory, which uses less memory "
+        "and hashes faster. The output is the same.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of processes cleaning the releases.",
+    )
+    parser.add_argument(
+        "--no-prefilter",
+        action="store_true",
+        help="Decode every release. By default the lines without "
+        f"'{WRITTEN}', in any case, are dropped without decoding them, since "
+        "no track of theirs can have a writer.",
+    )
+    parser.add_argument(
+        "--verify-prefilter",
+        action="store_true",
+        help="Decode and clean every release and check that the pre-filter "
+        "does not reject any release that is kept, with or without "
+        "--no-prefilter. The output is the same. Exits with an error if it does.",
+    )
     args = parser.parse_args()
 
     # Read the input json, process and write to output_json
-    main(args.input_json, args.artists_json, args.output_json)
+    main(
+        args.input_json,
+        args.artists_json,
+        args.output_json,
+        args.int_ids,
+        args.workers,
+        not args.no_prefilter,
+        args.verify_prefilter,
+    )
 
     #############
     print("Done!")
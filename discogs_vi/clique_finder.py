@@ -3,42 +3,196 @@ artists_json finds cliques and versions. Saves the cliques in a jsonl file."""
 
 import os
 import sys
-import json
 import time
 import argparse
+from heapq import heappush, heappop
 from collections import defaultdict
-from itertools import combinations
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from utilities.utils import (
     collect_writer_artists,
     collect_performance_artists,
     hard_clean_text,
+    print_text_cache_stats,
+    RelatedArtistsIndex,
+)
+from utilities.jsonl_io import open_jsonl, is_compressed
+from utilities.json_codec import loads, dumps
+from utilities.metrics import StageMetrics
+from utilities.records import Track, Version, Clique
+from utilities.release_table import get_release_table_path, load_release_table
+from utilities.artist_graph import (
+    get_graph_dir,
+    build_artist_graph,
+    save_artist_graph,
+    load_artist_graph,
+    load_valid_artist_graph,
+    RELATIONS,
 )
 
+# Artist ids of a track used for collecting its performers and writers
+ARTIST_ID_KEYS = (
+    "track_artist_ids",
+    "release_artist_ids",
+    "track_feat_ids",
+    "track_writer_ids",
+)
 
-class SetEncoder(json.JSONEncoder):
-    """Convert sets to lists for json encoding"""
+# Groups of a title up to which merging compares all the pairs of groups
+# instead of indexing their writers
+SMALL_GROUPS = 32
 
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
 
+def load_artists_dict(artists_json, int_ids=False):
+    """Loads the artist relations to a dict of dicts with artist ids as keys.
+    With int_ids the artist ids, keys and related artists, are ints."""
 
-def read_tracks(tracks_json, artists_dict):
-    """Reads the tracks in the json file to a dict of lists with track titles as keys."""
+    artists_dict = {}
+    with open_jsonl(artists_json) as infile:
+        for jsonline in infile:
+            artist = loads(jsonline)
+            artist_id = artist.pop("id")
+            if int_ids:
+                artist_id = int(artist_id)
+                for relation in RELATIONS:
+                    if relation in artist:
+                        artist[relation] = [int(_id) for _id in artist[relation]]
+            artists_dict[artist_id] = artist
+    return artists_dict
+
+
+def merge_pairs(groups):
+    """Merges the [writers, items] groups with intersecting writers in place,
+    as merge_intersecting_writers, by comparing all the pairs of groups after
+    every merge. It is faster for a few groups."""
+
+    merged = True
+    while merged:
+        merged = False
+        for i, (writers, _) in enumerate(groups):
+            for j in range(i + 1, len(groups)):
+                if not writers.isdisjoint(groups[j][0]):
+                    groups[i][0] = writers = writers.union(groups[j][0])
+                    groups[i][1].extend(groups[j][1])
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+
+def index_writers(groups):
+    """Returns an inverted index from each writer to the indices of the
+    [writers, items] groups that contain it, in increasing order."""
+
+    writer_index = defaultdict(list)
+    for i, (writers, _) in enumerate(groups):
+        for writer in writers:
+            writer_index[writer].append(i)
+    return writer_index
+
+
+def merge_intersecting_writers(groups):
+    """Merges the [writers, items] groups with intersecting writers in place,
+    with the same result as repeatedly merging the first pair of groups with
+    common writers into the earlier one until there is none. Each group is
+    grown from its first member by merging the first group that shares a
+    writer with it, found through an inverted index from writer to groups
+    instead of comparing all the pairs, so the items keep their order."""
+
+    if len(groups) < 2:
+        return
+    if len(groups) <= SMALL_GROUPS:
+        merge_pairs(groups)
+        return
+    writer_index = index_writers(groups)
+    # No writer is in more than one group
+    if len(writer_index) == sum(map(len, writer_index.values())):
+        return
+    merged = [False] * len(groups)
+    survivors = []
+    for i, group in enumerate(groups):
+        if merged[i]:
+            continue
+        merged[i] = True
+        # The groups that share a writer with the group, smallest index first
+        candidates, seen_writers = [], set()
+        new_writers = group[0]
+        while True:
+            for writer in new_writers:
+                if writer not in seen_writers:
+                    seen_writers.add(writer)
+                    for j in writer_index[writer]:
+                        if not merged[j]:
+                            heappush(candidates, j)
+            while candidates and merged[candidates[0]]:
+                heappop(candidates)
+            if not candidates:
+                break
+            j = heappop(candidates)
+            merged[j] = True
+            new_writers, items = groups[j]
+            group[1].extend(items)
+        if len(seen_writers) > len(group[0]):
+            group[0] = frozenset(seen_writers)
+        survivors.append(group)
+    groups[:] = survivors
+
+
+def assert_disjoint_writers(groups, message=None):
+    """Checks that no writer is in more than one of the [writers, items]
+    groups."""
+
+    for indices in index_writers(groups).values():
+        assert len(indices) == 1, message
+
+
+def read_tracks(
+    tracks_json, artists_dict, metrics=None, cache=True, int_ids=False, releases=None
+):
+    """Reads the tracks in the json file to a dict of lists with track titles as keys.
+    The tracks are kept as Track records that share the values of their
+    release. The tracks are counted in metrics if it is given. With cache, the related
+    artists of each artist are collected only once. With int_ids, artists_dict
+    must use int ids and the writer and performer sets are sets of ints, the
+    tracks keep their string ids. With releases, the ReleaseTable of normalized
+    tracks, the tracks are kept normalized and joined to it."""
 
     t0 = time.monotonic()
 
+    if cache and not isinstance(artists_dict, RelatedArtistsIndex):
+        artists_dict = RelatedArtistsIndex(artists_dict)
+
     n_tracks, tracks_dict = 0, defaultdict(lambda: defaultdict(list))
+    previous = None
     print(f"Reading the tracks...")
-    with open(tracks_json, encoding="utf-8") as in_f:
+    with open_jsonl(tracks_json) as in_f:
+        if metrics is not None:
+            metrics.in_f = in_f
         for jsonline in in_f:
-            track = json.loads(jsonline)
+            if releases is None:
+                track = Track.from_dict(loads(jsonline))
+            else:
+                track = releases.track(loads(jsonline))
+            # The tracks of a release are consecutive, keep their release once
+            if type(track) is Track:
+                if type(previous) is Track:
+                    track.share_release(previous)
+                previous = track
             n_tracks += 1
-            track_artists = frozenset(collect_performance_artists(track, artists_dict))
-            track_writers = frozenset(collect_writer_artists(track, artists_dict))
+            if metrics is not None:
+                metrics.step()
+            if int_ids:
+                # Convert the ids of the track once, only for the collectors
+                track_ids = {
+                    key: [int(_id) for _id in track[key]] for key in ARTIST_ID_KEYS
+                }
+            else:
+                track_ids = track
+            track_artists = frozenset(
+                collect_performance_artists(track_ids, artists_dict)
+            )
+            track_writers = frozenset(collect_writer_artists(track_ids, artists_dict))
             found = False
             # Check if the track is already in the dictionary
             for i, (writers, _) in enumerate(
@@ -59,6 +213,8 @@ def read_tracks(tracks_json, artists_dict):
                     [track_writers, [track]]
                 )
     print(f"There are {n_tracks:>10,} tracks.")
+    if isinstance(artists_dict, RelatedArtistsIndex):
+        print(f"Collected the related artists of {len(artists_dict):>10,} artists.")
     print(f"There are {len(tracks_dict):>10,} unique track titles.")
 
     # Keep titles with more than one performer as only they can form cliques
@@ -72,31 +228,12 @@ def read_tracks(tracks_json, artists_dict):
     print("Merging tracks with intersecting writers into versions...")
     for track_title, title_dict in tracks_dict.items():
         for writers_and_tracks in title_dict.values():
-            merged = True
-            while merged:
-                merged = False
-                for i, (writers, _) in enumerate(writers_and_tracks):
-                    for j, (writers2, tracks2) in enumerate(
-                        writers_and_tracks[i + 1 :]
-                    ):
-                        # If there are common writers, merge the tracks and writers
-                        if writers & writers2:
-                            # Update the writers
-                            writers_and_tracks[i][0] = writers.union(writers2)
-                            # Merge the tracks
-                            writers_and_tracks[i][1].extend(tracks2)
-                            # Delete the second writer
-                            del writers_and_tracks[i + j + 1]
-                            merged = True
-                            break
-                    if merged:
-                        break
+            merge_intersecting_writers(writers_and_tracks)
 
     # Test for intersection of writers
     for track_title, title_dict in tracks_dict.items():
         for writers_and_tracks in title_dict.values():
-            for x1, x2 in combinations(writers_and_tracks, 2):
-                assert x1[0] & x2[0] == frozenset(), track_title
+            assert_disjoint_writers(writers_and_tracks, track_title)
 
     # Remove tracks with bad writer annotations
     # TODO: a smalle percetange of versions require union of artist sets to eliminate writer disagreements
@@ -145,6 +282,64 @@ def read_tracks(tracks_json, artists_dict):
     return tracks_dict
 
 
+def group_versions(versions):
+    """Groups the [writers, tracks] versions of a title into [writers,
+    versions] cliques of versions with intersecting writers. Each version is
+    added to the first clique that shares a writer with it, and then the
+    cliques with intersecting writers are merged. Up to SMALL_GROUPS versions
+    the cliques are compared with each version, otherwise the first clique is
+    found through the first clique of each writer, unless no writer is in two
+    versions."""
+
+    # A clique = [version_writers, versions=[[tracks=[...]], [tracks=[...]], ...]]
+    cliques = []
+    # Most titles have a few versions, compare each of them with the cliques
+    if len(versions) <= SMALL_GROUPS:
+        for version_writers, version_tracks in versions:
+            for clique in cliques:
+                if not clique[0].isdisjoint(version_writers):
+                    clique[0] = clique[0].union(version_writers)
+                    clique[1].append(version_tracks)
+                    break
+            else:
+                cliques.append([version_writers, [version_tracks]])
+        merge_pairs(cliques)
+        return cliques
+
+    # No writer is in more than one version, each version is a clique
+    n_writers = sum(len(version_writers) for version_writers, _ in versions)
+    if len(set().union(*(w for w, _ in versions))) == n_writers:
+        for version_writers, version_tracks in versions:
+            cliques.append([version_writers, [version_tracks]])
+        return cliques
+
+    # The index of the first clique that contains each writer
+    first_clique = {}
+    for version_writers, version_tracks in versions:
+        # The first clique of the writers of the version, if there is one
+        i = n_cliques = len(cliques)
+        for writer in version_writers:
+            j = first_clique.get(writer, n_cliques)
+            if j < i:
+                i = j
+        # If the clique exists, add the version to it
+        if i < n_cliques:
+            # Merge the writers of the clique
+            cliques[i][0] = cliques[i][0].union(version_writers)
+            # Add the version_tracks to the clique
+            cliques[i][1].append(version_tracks)
+        # Create a new clique with the version_writers and the version_tracks of tracks
+        else:
+            cliques.append([version_writers, [version_tracks]])
+        # The clique is now the first one of all the writers of the version
+        for writer in version_writers:
+            first_clique[writer] = i
+
+    # Merge cliques with intersecting writers
+    merge_intersecting_writers(cliques)
+    return cliques
+
+
 def find_cliques(tracks_dict):
 
     t0 = time.monotonic()
@@ -152,46 +347,7 @@ def find_cliques(tracks_dict):
     # Create cliques and versions
     cliques_dict = {}
     for track_title, title_dict in tracks_dict.items():
-        cliques_dict[track_title] = []
-        for version_writers, version_tracks in title_dict.values():
-
-            # If the clique exists, add the version to it
-            # A clique = [version_writers, versions=[[tracks=[...]], [tracks=[...]], ...]]
-            found = False
-            for i, (clique_writers, _) in enumerate(cliques_dict[track_title]):
-                if clique_writers & version_writers:
-                    # Merge the writers of the clique
-                    cliques_dict[track_title][i][0] = clique_writers.union(
-                        version_writers
-                    )
-                    # Add the version_tracks to the clique
-                    cliques_dict[track_title][i][1].append(version_tracks)
-                    found = True
-                    break
-            # Create a new clique with the version_writers and the version_tracks of tracks
-            if not found:
-                cliques_dict[track_title].append([version_writers, [version_tracks]])
-
-    # Merge cliques with intersecting writers
-    for track_title in cliques_dict.keys():
-        merged = True
-        while merged:
-            merged = False
-            for i, (writers, _) in enumerate(cliques_dict[track_title]):
-                for j, (writers2, versions2) in enumerate(
-                    cliques_dict[track_title][i + 1 :]
-                ):
-                    if writers & writers2:
-                        # Merge the writers
-                        cliques_dict[track_title][i][0] = writers.union(writers2)
-                        # Put the versions together
-                        cliques_dict[track_title][i][1].extend(versions2)
-                        # Delete the second clique
-                        del cliques_dict[track_title][i + j + 1]
-                        merged = True
-                        break
-                if merged:
-                    break
+        cliques_dict[track_title] = group_versions(title_dict.values())
 
     # Remove cliques with only one version
     print("Removing cliques with only one version...")
@@ -201,8 +357,7 @@ def find_cliques(tracks_dict):
     }
     # Check for intersection of writers in cliques after the merge
     for clique_list in cliques_dict.values():
-        for clique_a, clique_b in combinations(clique_list, 2):
-            assert clique_a[0] & clique_b[0] == frozenset()
+        assert_disjoint_writers(clique_list)
 
     # Remove the writer artists from the cliques_dict
     for cliques in cliques_dict.values():
@@ -240,9 +395,13 @@ def find_cliques(tracks_dict):
     return cliques_dict
 
 
-def main(input_json, artists_json, output_json=None):
+def main(input_json, artists_json, output_json=None, graph=False, int_ids=False):
     """Reads the tracks in the input_json, finds the unique track
-    titles, and uses them and common writers to finds cliques."""
+    titles, and uses them and common writers to finds cliques. The artist
+    relations are read from the memory-mapped artist graph saved next to the
+    artists_json if it is up to date. Otherwise, if graph is True the graph is
+    rebuilt and else the relations are loaded in a dictionary. With int_ids the
+    artist ids are handled as ints in memory."""
 
     # If no name is provided set it to Discogs-VI-YYYY_MM_DD.jsonl
     if output_json is None:
@@ -251,6 +410,8 @@ def main(input_json, artists_json, output_json=None):
             input_json.split("_releases.xml")[0].split("/")[-1].split("discogs_")[-1]
         )
         output_json = os.path.join(_dir, f"Discogs-VI-{dump_date}.jsonl")
+        if is_compressed(input_json):
+            output_json += ".zst"
         print(f"Cliques will be saved to: {output_json}")
 
     # Check the output path for not over-writing
@@ -264,47 +425,67 @@ def main(input_json, artists_json, output_json=None):
     if output_dir != "":
         os.makedirs(output_dir, exist_ok=True)
 
-    # Load the artists dictionary
-    print("Loading the artists dictionary...")
-    artists_dict = {}
-    with open(artists_json, encoding="utf-8") as infile:
-        for jsonline in infile:
-            artist = json.loads(jsonline)
-            artists_dict[artist["id"]] = artist
-            del artists_dict[artist["id"]]["id"]
+    # Use the artist graph saved by clean_artists.py if it is up to date
+    artists_dict = load_valid_artist_graph(artists_json, int_ids)
+    if artists_dict is not None:
+        print("Loaded the artist graph.")
+    elif graph:
+        graph_dir = get_graph_dir(artists_json)
+        print(f"Building the artist graph in {graph_dir}...")
+        save_artist_graph(build_artist_graph(artists_json), graph_dir, artists_json)
+        artists_dict = load_artist_graph(graph_dir, int_ids=int_ids)
+    else:
+        # Load the artists dictionary
+        print("Loading the artists dictionary...")
+        artists_dict = load_artists_dict(artists_json, int_ids)
+
+    # The release table of the normalized tracks, if there is one
+    releases = load_release_table(input_json)
 
     # Read track information and apply preprocessing
-    tracks_dict = read_tracks(input_json, artists_dict)
+    metrics = StageMetrics("clique_finder", input_json)
+    tracks_dict = read_tracks(
+        input_json, artists_dict, metrics, int_ids=int_ids, releases=releases
+    )
 
     # Clique and Version detection algorithm
     n_cliques, n_versions, n_tracks = 0, 0, 0
+    release_ids = {}
     print("Searching for cliques and versions...")
     cliques_dict = find_cliques(tracks_dict)
-    # Get the different cliques that share the same title
-    for cliques in cliques_dict.values():
-        # For each clique create a dictionary
-        for clique in cliques:
-            clique_dict = {
-                "clique_id": f"C-{str(n_cliques).zfill(7)}",
-                "versions": [],
-            }
-            n_cliques += 1
-            for version in clique:
-                clique_dict["versions"].append(
-                    {
-                        "version_id": f"V-{str(n_versions).zfill(7)}",
-                        "tracks": version,
-                    }
-                )
-                n_versions += 1
-                n_tracks += len(version)
-            with open(output_json, "a", encoding="utf-8") as outfile:
-                outfile.write(
-                    json.dumps(clique_dict, cls=SetEncoder, ensure_ascii=False) + "\n"
+    with open_jsonl(output_json, "a") as outfile:
+        metrics.out_f = outfile
+        # Get the different cliques that share the same title
+        for cliques in cliques_dict.values():
+            # For each clique create a dictionary
+            for clique in cliques:
+                clique_record = Clique(
+                    clique_id=f"C-{str(n_cliques).zfill(7)}",
+                    versions=[],
                 )
+                n_cliques += 1
+                for version in clique:
+                    clique_record.versions.append(
+                        Version(
+                            version_id=f"V-{str(n_versions).zfill(7)}",
+                            tracks=version,
+                        )
+                    )
+                    n_versions += 1
+                    n_tracks += len(version)
+                    if releases is not None:
+                        release_ids.update(
+                            dict.fromkeys(track["release_id"] for track in version)
+                        )
+                outfile.write(dumps(clique_record) + "\n")
+        metrics.close()
+    # Keep the releases of the written tracks next to the cliques
+    if releases is not None:
+        releases.save(get_release_table_path(output_json), release_ids)
     print(
         f"{n_cliques:>9,} cliques are versioned into {n_versions:>9,} versions with {n_tracks:>10,} tracks."
     )
+    print_text_cache_stats()
     print("Finished the search.")
 
 
@@ -326,11 +507,33 @@ if __name__ == "__main__":
         default=None,
         help="Path to json file to write cliques. Leave empty for auto.",
     )
+    parser.add_argument(
+        "--graph",
+        "-g",
+        action="store_true",
+        help="Build the memory-mapped artist graph of utilities/artist_graph.py "
+        "next to artists_json if it does not exist or is out of date, instead "
+        "of loading the artists in a dictionary. An up to date graph, e.g. the "
+        "one saved by clean_artists.py, is always used.",
+    )
+    parser.add_argument(
+        "--int-ids",
+        "-i",
+        action="store_true",
+        help="Keep the artist ids as integers in memory, which uses less memory "
+        "and hashes faster. The output is the same.",
+    )
     args = parser.parse_args()
 
     # Read the input json, artists json and process them.
     # Write the outputs to output_json
-    main(args.input_json, args.artists_json, args.output_json)
+    main(
+        args.input_json,
+        args.artists_json,
+        args.output_json,
+        args.graph,
+        args.int_ids,
+    )
 
     ##############
     print("Done!")
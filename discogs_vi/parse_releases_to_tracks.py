@@ -5,22 +5,40 @@ shoul be cleaned with clean_releases_for_versioning.py before using this script.
 import os
 import re
 import sys
-import json
 import time
 import argparse
+from contextlib import nullcontext
+from collections import Counter
 
 from variables import (
-    WRITTEN,
-    FEAT,
-    EXCLUDE_ARTISTS,
     EXCLUDE_TITLES,
     N_MAX_ARTISTS,
 )
+from clean_releases import load_artist_ids, ROLES, WRITER, FEATURING
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from utilities.utils import hard_clean_text, clean_parentheses
+from utilities.utils import (
+    hard_clean_text,
+    clean_parentheses,
+    memoize_text,
+    text_cache_counts,
+    print_text_cache_stats,
+)
+from utilities.jsonl_io import open_jsonl, add_suffix
+from utilities.json_codec import loads, dumps
+from utilities.metrics import StageMetrics
+from utilities.parallel import imap_chunks, progress_steps
+from utilities.records import Release, Track, NormalizedTrack, ReleaseRow
+from utilities.release_table import get_release_table_path
+
+# Number of tracks skipped by format_tracks for each reason
+TRACK_DROPS = Counter()
+
+# Set in each worker process by init_worker
+worker_artist_ids, worker_normalize = None, False
 
 
+@memoize_text
 def remove_disogs_pattern(artist):
     """Removes the Discogs pattern from the artist name. 'Oguz (3)' type of Discogs convention"""
     return re.sub(r"\s\(\d+?\)", "", artist)
@@ -47,11 +65,15 @@ def fix_artists(t_artists, t_feat_artists):
 # TODO: what if release artist is EXCLUDE_ARTIST?
 def format_tracks(release, all_artist_ids):
     """Takes a release and parses its tracks. The metadata is put in a format
-    for finding clique and version relationships."""
+    for finding clique and version relationships. all_artist_ids is an
+    ArtistIds set of clean_releases.py. Returns a list of Track records."""
+
+    key = all_artist_ids.key
+    release = Release.from_release(release)
 
     # Collect release artist ids and names
     r_artist_ids, r_artist_names = [], []
-    for ra in release["artists"]:
+    for ra in release.artists:
         r_artist_ids.append(ra["id"])
         r_artist_names.append(ra["name"])
 
@@ -59,17 +81,14 @@ def format_tracks(release, all_artist_ids):
     # clean_releases_for_versioning.py already cleaned up the roles
     r_writer_ids, r_writer_names = [], []
     r_feat_ids, r_feat_names = [], []
-    for rea in release["extraartists"]:
-        role = rea["role"].lower()
-        if WRITTEN in role:
+    for rea in release.extraartists:
+        kind = ROLES[rea["role"]]
+        if kind is WRITER:
             r_writer_ids.append(rea["id"])
             r_writer_names.append(remove_disogs_pattern(rea["name"]))
-        else:
-            for f in FEAT:
-                if f in role:
-                    r_feat_ids.append(rea["id"])
-                    r_feat_names.append(rea["name"])
-                    break
+        elif kind is FEATURING:
+            r_feat_ids.append(rea["id"])
+            r_feat_names.append(rea["name"])
 
     # Clean up the artists and feat artists, remove intersections
     r_artist_ids, r_feat_ids = fix_artists(r_artist_ids, r_feat_ids)
@@ -81,15 +100,17 @@ def format_tracks(release, all_artist_ids):
 
     # For each track, collect information
     tracks = []
-    for t in release["tracklist"]:
+    for t in release.tracklist:
         assert len(t["extraartists"]) > 0, "No extraartists left in track."
 
         # Skip tracks with no title
         if t["title"] == "":
+            TRACK_DROPS["no_title"] += 1
             continue
 
         # Exclude tracks with certain titles
         if t["title"].lower() in EXCLUDE_TITLES:
+            TRACK_DROPS["excluded_title"] += 1
             continue
 
         # Clean the title for comparison
@@ -103,10 +124,13 @@ def format_tracks(release, all_artist_ids):
                 t_artist_ids.append(ta["id"])
                 t_artist_names.append(ta["name"])
         # Skip tracks with generic artists
-        if len(set(t_artist_ids).intersection(EXCLUDE_ARTISTS)) > 0:
+        t_artist_keys = set(map(key, t_artist_ids))
+        if len(t_artist_keys.intersection(all_artist_ids.excluded)) > 0:
+            TRACK_DROPS["excluded_artists"] += 1
             continue
         # Skip tracks with artists that are not in the artist file
-        if len(set(t_artist_ids).difference(all_artist_ids)) > 0:
+        if len(t_artist_keys.difference(all_artist_ids)) > 0:
+            TRACK_DROPS["unknown_artists"] += 1
             continue
 
         # Classify track extraartists as writers or features
@@ -114,23 +138,24 @@ def format_tracks(release, all_artist_ids):
         t_writer_ids, t_writer_names = [], []
         t_feat_ids, t_feat_names = [], []
         for tea in t["extraartists"]:
-            role = tea["role"].lower()
-            if WRITTEN in role:
+            kind = ROLES[tea["role"]]
+            if kind is WRITER:
                 t_writer_ids.append(tea["id"])
                 t_writer_names.append(remove_disogs_pattern(tea["name"]))
-            else:
-                for f in FEAT:
-                    if f in role:
-                        t_feat_ids.append(tea["id"])
-                        t_feat_names.append(tea["name"])
-                        break
+            elif kind is FEATURING:
+                t_feat_ids.append(tea["id"])
+                t_feat_names.append(tea["name"])
         # Skip tracks with generic artists
-        if len(EXCLUDE_ARTISTS.intersection(set(t_writer_ids))) > 0:
+        if len(all_artist_ids.excluded.intersection(map(key, t_writer_ids))) > 0:
+            TRACK_DROPS["excluded_writers"] += 1
             continue
-        if len(EXCLUDE_ARTISTS.intersection(set(t_feat_ids))) > 0:
+        t_feat_keys = set(map(key, t_feat_ids))
+        if len(all_artist_ids.excluded.intersection(t_feat_keys)) > 0:
+            TRACK_DROPS["excluded_feats"] += 1
             continue
         # Skip tracks with artists that are not in the artist file
-        if len(set(t_feat_ids).difference(all_artist_ids)) > 0:
+        if len(t_feat_keys.difference(all_artist_ids)) > 0:
+            TRACK_DROPS["unknown_feats"] += 1
             continue
 
         # Clean up the artists and feat artists, remove intersections
@@ -139,6 +164,7 @@ def format_tracks(release, all_artist_ids):
 
         # Keep only tracks with up to N_MAX_ARTISTS artists for Youtube search
         if len(t_artist_ids) > N_MAX_ARTISTS or len(t_feat_ids) > N_MAX_ARTISTS:
+            TRACK_DROPS["too_many_artists"] += 1
             continue
 
         # Remove the Discogs pattern from the track artist names
@@ -147,45 +173,145 @@ def format_tracks(release, all_artist_ids):
 
         # Put the track in the required format and append to tracks
         tracks.append(
-            {
-                "track_title": t["title"],
-                "release_title": release["title"],
-                "track_writer_ids": t_writer_ids,
-                "track_writer_names": t_writer_names,
-                "track_artist_ids": t_artist_ids,
-                "track_artist_names": t_artist_names,
-                "track_feat_ids": t_feat_ids,
-                "track_feat_names": t_feat_names,
-                "release_id": release["id"],
-                "release_artist_ids": r_artist_ids,
-                "release_artist_names": r_artist_names,
-                "release_writer_ids": r_writer_ids,
-                "release_writer_names": r_writer_names,
-                "release_feat_ids": r_feat_ids,
-                "release_feat_names": r_feat_names,
-                "release_genres": release["genres"],
-                "release_styles": release["styles"],
-                "country": release["country"],
-                "labels": release["labels"],
-                "formats": release["formats"],
-                "master_id": release["master_id"],
-                "main_release": release["main_release"],
-                "release_videos": release["videos"],
-                "released": release["released"],
-                "track_title_cleaned": clean_title,
-            }
+            Track(
+                track_title=t["title"],
+                release_title=release.title,
+                track_writer_ids=t_writer_ids,
+                track_writer_names=t_writer_names,
+                track_artist_ids=t_artist_ids,
+                track_artist_names=t_artist_names,
+                track_feat_ids=t_feat_ids,
+                track_feat_names=t_feat_names,
+                release_id=release.id,
+                release_artist_ids=r_artist_ids,
+                release_artist_names=r_artist_names,
+                release_writer_ids=r_writer_ids,
+                release_writer_names=r_writer_names,
+                release_feat_ids=r_feat_ids,
+                release_feat_names=r_feat_names,
+                release_genres=release.genres,
+                release_styles=release.styles,
+                country=release.country,
+                labels=release.labels,
+                formats=release.formats,
+                master_id=release.master_id,
+                main_release=release.main_release,
+                release_videos=release.videos,
+                released=release.released,
+                track_title_cleaned=clean_title,
+            )
         )
 
     return tracks
 
 
-def main(input_json, artists_json, output_json=None):
+def encode_tracks(tracks, normalize=False):
+    """Returns the JSON lines of the tracks of a release and the line of the
+    release in the release table. Without normalize the tracks have all their
+    fields and the release line is empty. With normalize they are written as
+    NormalizedTrack records and the release as a ReleaseRow."""
+
+    if not normalize:
+        return "".join(dumps(track) + "\n" for track in tracks), ""
+    lines = [dumps(NormalizedTrack.from_track(track)) + "\n" for track in tracks]
+    return "".join(lines), dumps(ReleaseRow.from_track(tracks[0])) + "\n"
+
+
+def init_worker(all_artist_ids, normalize=False):
+    """Keeps the artist ids and the output mode in the worker process, see
+    imap_chunks."""
+
+    global worker_artist_ids
+    global worker_normalize
+
+    worker_artist_ids, worker_normalize = all_artist_ids, normalize
+
+
+def parse_chunk(lines):
+    """Parses a chunk of release lines in a worker. Returns the output lines
+    of the tracks and of the release table, the number of releases, of
+    releases with tracks and of tracks, and the TRACK_DROPS and the text cache
+    counts of the chunk."""
+
+    # Count the drops and the cache hits of this chunk only
+    TRACK_DROPS.clear()
+    cache_counts = text_cache_counts()
+    output, table_output, r_success, t_total = [], [], 0, 0
+    for jsonline in lines:
+        tracks = format_tracks(loads(jsonline), worker_artist_ids)
+        if len(tracks) > 0:
+            t_total += len(tracks)
+            r_success += 1
+            track_lines, release_line = encode_tracks(tracks, worker_normalize)
+            output.append(track_lines)
+            table_output.append(release_line)
+    cache_counts = text_cache_counts() - cache_counts
+    return (
+        "".join(output),
+        "".join(table_output),
+        len(lines),
+        r_success,
+        t_total,
+        TRACK_DROPS,
+        cache_counts,
+    )
+
+
+def parse_in_chunks(
+    in_f, out_f, all_artist_ids, workers, metrics, table_f=None, input_json=None
+):
+    """Parses the releases of in_f with a pool of workers, in chunks of
+    lines, and writes the tracks to out_f in the input order. If input_json,
+    the path of in_f, can be split, the workers read the chunks from it. If
+    table_f is given the tracks are normalized and the releases are written to
+    it. Returns the number of releases, releases with tracks and tracks, and
+    the text cache counts of the workers. TRACK_DROPS is updated as if the
+    releases were parsed in this process."""
+
+    r_total, r_success, t_total = 0, 0, 0
+    cache_counts = Counter()
+    initargs = (all_artist_ids, table_f is not None)
+    for (
+        output,
+        table_output,
+        n,
+        n_success,
+        n_tracks,
+        drops,
+        counts,
+    ) in imap_chunks(
+        in_f, parse_chunk, workers, init_worker, initargs, input_json, metrics
+    ):
+        out_f.write(output)
+        if table_f is not None:
+            table_f.write(table_output)
+        for n_parsed in progress_steps(r_total, n):
+            print(f"Parsed {n_parsed:>9,} releases.")
+        r_total += n
+        r_success += n_success
+        t_total += n_tracks
+        TRACK_DROPS.update(drops)
+        cache_counts.update(counts)
+        metrics.step(n)
+    return r_total, r_success, t_total, cache_counts
+
+
+def main(
+    input_json,
+    artists_json,
+    output_json=None,
+    int_ids=False,
+    workers=1,
+    normalize=False,
+):
     """Use the clean json file containing releases. Parses the tracks inside
-    the releases and excludes certain tracks that are not usefull for cliques."""
+    the releases and excludes certain tracks that are not usefull for cliques.
+    With normalize, the release fields are written once per release to a
+    release table next to the output file instead of with every track."""
 
     # Determine the output path if not provided
     if not output_json:
-        output_json = input_json + ".tracks"
+        output_json = add_suffix(input_json, ".tracks")
         print(f"Tracks will be saved to: {output_json}")
     # Create the parent directory if it does not exist
     output_dir = os.path.dirname(output_json)
@@ -197,39 +323,57 @@ def main(input_json, artists_json, output_json=None):
         if input(f"{output_json} exists. Remove?[Y/n] ") == "n":
             output_json = input(f"New .json path?\n")
 
+    if normalize:
+        table_json = get_release_table_path(output_json)
+        print(f"Releases will be saved to: {table_json}")
+
     # Load all the artist ids from the json file
     print("Loading all artist ids...")
-    all_artist_ids = set()
-    with open(artists_json, encoding="utf-8") as infile:
-        for jsonline in infile:
-            # Load the artist information
-            artist_dict = json.loads(jsonline)
-            # Add the artist's ID to the set of artists with releases
-            all_artist_ids.update({artist_dict["id"]})
+    all_artist_ids = load_artist_ids(artists_json, int_ids)
 
     # Search each track inside each release for certain information
     print("Parsing releases to tracks and filtering tracks with certain metadata...")
     t0 = time.monotonic()
     r_total, r_success, t_total = 0, 0, 0
-    with open(input_json, encoding="utf-8") as in_f, open(
-        output_json, "w", encoding="utf-8"
-    ) as out_f:
-        for jsonline in in_f:
-            # Load the release
-            release = json.loads(jsonline)
-            # Put the tracks in the required format
-            tracks = format_tracks(release, all_artist_ids)
-            # If there are tracks, write them to the output file as json lines
-            if len(tracks) > 0:
-                t_total += len(tracks)
-                r_success += 1
-                # Write each track to a separate json line
-                for track in tracks:
-                    out_f.write(json.dumps(track, ensure_ascii=False) + "\n")
-            r_total += 1
-            if not r_total % 500000:
-                print(f"Parsed {r_total:>9,} releases.")
+    cache_counts = Counter()
+    # Without normalize there is no release table and table_f is None
+    with open_jsonl(input_json) as in_f, open_jsonl(output_json, "w") as out_f, (
+        open_jsonl(table_json, "w") if normalize else nullcontext()
+    ) as table_f:
+        metrics = StageMetrics(
+            "parse_releases_to_tracks",
+            input_json,
+            in_f,
+            out_f,
+            {"format_tracks": TRACK_DROPS},
+        )
+        if workers > 1:
+            r_total, r_success, t_total, cache_counts = parse_in_chunks(
+                in_f, out_f, all_artist_ids, workers, metrics, table_f, input_json
+            )
+        else:
+            # With a single worker, parse the releases in this process
+            for jsonline in in_f:
+                # Load the release
+                release = loads(jsonline)
+                # Put the tracks in the required format
+                tracks = format_tracks(release, all_artist_ids)
+                # If there are tracks, write them to the output file as json lines
+                if len(tracks) > 0:
+                    t_total += len(tracks)
+                    r_success += 1
+                    # Write each track to a separate json line
+                    track_lines, release_line = encode_tracks(tracks, normalize)
+                    out_f.write(track_lines)
+                    if normalize:
+                        table_f.write(release_line)
+                r_total += 1
+                metrics.step()
+                if not r_total % 500000:
+                    print(f"Parsed {r_total:>9,} releases.")
+        metrics.close()
     print(f"Parsed {r_total:>9,} releases to {t_total:>9,} tracks.")
+    print_text_cache_stats(cache_counts + text_cache_counts())
     print(
         f"Processing time: {time.strftime('%M:%S', time.gmtime(time.monotonic()-t0))}"
     )
@@ -256,10 +400,39 @@ if __name__ == "__main__":
         help="Output line-delimited JSON file with writer information."
         " Leave empty for automatically determining the path.",
     )
+    parser.add_argument(
+        "--int-ids",
+        "-i",
+        action="store_true",
+        help="Keep the artist ids as integers in memory, which uses less memory "
+        "and hashes faster. The output is the same.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of processes parsing the releases.",
+    )
+    parser.add_argument(
+        "--normalize",
+        "-n",
+        action="store_true",
+        help="Write the tracks with their track fields and release_id only, "
+        "and the release fields once per release in a release table next to "
+        "the output file, output_json + .releases.",
+    )
     args = parser.parse_args()
 
     # Read the input json, process and write to output_json
-    main(args.input_json, args.artists_json, args.output_json)
+    main(
+        args.input_json,
+        args.artists_json,
+        args.output_json,
+        args.int_ids,
+        args.workers,
+        args.normalize,
+    )
 
     #############
     print("Done!")
@@ -3,12 +3,37 @@ the output in a line-delimited JSON file where each line corresponds to a
 particular release."""
 
 import os
-import json
+import sys
 import time
-import xmltodict
+from multiprocessing import Pool
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+from xml_utils import (
+    PARSERS,
+    DECOMPRESSORS,
+    get_output_name,
+    open_xml,
+    parse_xml,
+    split_xml_file,
+    read_xml_range,
+    merge_shards,
+)
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utilities.json_codec import dumps
+from utilities.metrics import StageMetrics
+
 processed = 0
+metrics = None
+
+# Fields that are removed from each artist. The expat parser does not build them.
+REMOVE_KEYS = [
+    "images",
+    "profile",
+    "data_quality",
+    "urls",
+    "realname",
+]
 
 # All keys in the artist dictionary:
 # ['realname', 'data_quality', 'aliases', 'urls', 'namevariations',
@@ -22,14 +47,7 @@ def get_artist(path, artist):
     global processed
 
     # Remove unnecessary fields.
-    remove_keys = [
-        "images",
-        "profile",
-        "data_quality",
-        "urls",
-        "realname",
-    ]
-    for key in remove_keys:
+    for key in REMOVE_KEYS:
         if key in artist:
             del artist[key]
 
@@ -65,13 +83,16 @@ def get_artist(path, artist):
             artist["members"]["id"] = [artist["members"]["id"]]
         if type(artist["members"]["name"]) is not list:
             artist["members"]["name"] = [artist["members"]["name"]]
-        # Simplify the members field while keeping the order
-        names = []
-        for id in artist["members"]["id"]:
-            for name in artist["members"]["name"]:
-                if id == name["@id"]:
-                    names.append(name["#text"])
-                    break
+        # Simplify the members field while keeping the order. The first
+        # name with a given id is used, as there can be duplicates.
+        id_to_name = {}
+        for name in artist["members"]["name"]:
+            id_to_name.setdefault(name["@id"], name)
+        names = [
+            id_to_name[id]["#text"]
+            for id in artist["members"]["id"]
+            if id in id_to_name
+        ]
         if len(names) == len(artist["members"]["id"]):
             artist["members"]["name"] = names
         else:
@@ -85,48 +106,111 @@ def get_artist(path, artist):
             artist[key] = [group["id"] for group in artist[key]]
 
     # Write the json to a file
-    json_f.write(json.dumps(artist, ensure_ascii=False) + "\n")
+    json_f.write(dumps(artist) + "\n")
 
     processed += 1
     if not processed % 100000:
         print(f"Processed {processed:>10,} artists")
+    if metrics is not None:
+        metrics.step()
 
     return True
 
 
-def main(xml_file, output_dir=None):
+def process_shard(shard):
+    """Parses a byte range of the xml file and writes its artists to a shard
+    output file. Returns the number of processed artists."""
+
+    global json_f
+    global processed
+    global metrics
+
+    xml_file, start, end, shard_path, parser = shard
+    # The main process keeps the metrics of the shards
+    processed, metrics = 0, None
+    with open(shard_path, "w", encoding="utf-8") as json_f:
+        parse_xml(
+            read_xml_range(xml_file, start, end, "artists"),
+            get_artist,
+            parser,
+            REMOVE_KEYS,
+        )
+    return processed
+
+
+def parse_in_shards(xml_file, output_path, workers, parser):
+    """Splits the xml file into byte ranges aligned on <artist> tags, parses
+    them with a pool of workers and merges the outputs in artist order."""
+
+    global processed
+
+    # Use more shards than workers to balance the load
+    shards = split_xml_file(xml_file, "artists", "artist", workers * 4)
+    shard_paths = [f"{output_path}.shard{i:04d}" for i in range(len(shards))]
+    print(f"Split the file into {len(shards):,} shards")
+
+    metrics = StageMetrics("preprocess_artists", xml_file, 0, 0)
+    with Pool(workers) as pool:
+        results = pool.imap(
+            process_shard,
+            [(xml_file, s, e, p, parser) for (s, e), p in zip(shards, shard_paths)],
+        )
+        for i, shard_processed in enumerate(results):
+            processed += shard_processed
+            print(f"Processed {processed:>10,} artists ({i+1}/{len(shards)} shards)")
+            # The xml file is parsed up to the end of the shard
+            metrics.in_f = shards[i][1]
+            metrics.out_f += os.path.getsize(shard_paths[i])
+            metrics.step(shard_processed)
+    metrics.close()
+
+    # Put the shards together in the original order
+    merge_shards(shard_paths, output_path)
+
 
-    assert os.path.splitext(xml_file)[1] == ".xml", "Input file must be an xml file"
+def main(
+    xml_file, output_dir=None, workers=1, parser="xmltodict", decompressor="python"
+):
+
+    assert xml_file.endswith((".xml", ".xml.gz")), "Input file must be an xml file"
+    assert (
+        workers == 1 or not xml_file.endswith(".gz")
+    ), "Multiple workers require an uncompressed xml file"
 
     # Write next to the xml file if no output_dir is specified
     if output_dir is None:
         output_dir = os.path.dirname(os.path.normpath(xml_file))
 
     # The output file will have the same name as the xml file but with .json extension
-    output_path = os.path.join(output_dir, f"{os.path.basename(xml_file)}.jsonl")
+    output_path = os.path.join(output_dir, get_output_name(xml_file))
 
     # Ask the user whether to delete the existing file
     if os.path.isfile(output_path):
         if input(f"{output_path} exists. Remove?[Y/n] ") == "n":
             output_path = input(f"New .json path?\n")
 
-    # Open the json files for writing
-    global json_f
-    json_f = open(output_path, "w", encoding="utf-8")
-
     # Parse and main the xml file
     start_time = time.monotonic()
     print(f"Loading {xml_file}")
-    xmltodict.parse(open(xml_file, "rb"), item_depth=2, item_callback=get_artist)
+    if workers > 1:
+        parse_in_shards(xml_file, output_path, workers, parser)
+    else:
+        # Open the json files for writing
+        global json_f
+        global metrics
+        json_f = open(output_path, "w", encoding="utf-8")
+        with open_xml(xml_file, decompressor) as xml_input:
+            metrics = StageMetrics("preprocess_artists", xml_file, xml_input, json_f)
+            parse_xml(xml_input, get_artist, parser, REMOVE_KEYS)
+            metrics.close()
+        # Close the json file
+        json_f.close()
     print(f"{processed:>10,} artists loaded")
     print(
         "Total processing time: "
         f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-start_time))}"
     )
 
-    # Close the json file
-    json_f.close()
-
 
 if __name__ == "__main__":
 
@@ -134,7 +218,10 @@ if __name__ == "__main__":
         description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        "xml_file", type=str, default=None, help='Input XML "releases" dump file.'
+        "xml_file",
+        type=str,
+        default=None,
+        help='Input XML "artists" dump file. Can be gzip compressed (.xml.gz).',
     )
     parser.add_argument(
         "--output-dir",
@@ -145,9 +232,36 @@ if __name__ == "__main__":
         "If not specified, the output file will be stored"
         "next to the input file.",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes. If larger than 1, the file is split "
+        "into byte ranges that are parsed in parallel.",
+    )
+    parser.add_argument(
+        "--parser",
+        "-p",
+        type=str,
+        choices=PARSERS,
+        default="xmltodict",
+        help="XML parser backend. expat streams the file without building "
+        "the fields that are removed afterwards. The output is the same.",
+    )
+    parser.add_argument(
+        "--decompressor",
+        "-d",
+        type=str,
+        choices=DECOMPRESSORS,
+        default="python",
+        help="How to decompress .xml.gz files. thread decompresses in a "
+        "background thread and pigz uses an external pigz process, both run "
+        "alongside parsing.",
+    )
     args = parser.parse_args()
 
-    main(args.xml_file, args.output_dir)
+    main(args.xml_file, args.output_dir, args.workers, args.parser, args.decompressor)
 
     #############
     print("Done!")
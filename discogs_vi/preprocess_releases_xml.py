@@ -3,33 +3,55 @@ the output in a line-delimited JSON file where each line corresponds to a
 particular release."""
 
 import os
+import sys
 import json
 import time
-import xmltodict
+from multiprocessing import Pool
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+from xml_utils import (
+    PARSERS,
+    DECOMPRESSORS,
+    get_output_name,
+    open_xml,
+    parse_xml,
+    skip_to_item,
+    split_xml_file,
+    read_xml_range,
+    merge_shards,
+)
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utilities.json_codec import dumps
+from utilities.metrics import StageMetrics
+
 processed = 0
 errors = 0
+metrics = None
 
+# Checkpointing state of the single process mode
+checkpoint_path = None
+checkpoint_interval = 300
+last_checkpoint = 0
+xml_parser = None
+# Position of the parser input in the xml file
+input_base = 0
+
+# Fields that are removed from each release. The expat parser does not build them.
+REMOVE_KEYS = ["images", "notes", "companies", "identifiers", "data_quality"]
 
-def get_release(path, release):
-    global errors
-    global processed
+
+def preprocess_release(path, release):
+    """Removes the unnecessary fields of a release and simplifies the rest.
+    Returns the release or None if it could not be read."""
 
     # Path: releases (root) -> release (id) -> ...
     release["id"] = path[1][1]["id"]
 
     # Remove unnecessary fields.
-    if "images" in release:
-        del release["images"]
-    if "notes" in release:
-        del release["notes"]
-    if "companies" in release:
-        del release["companies"]
-    if "identifiers" in release:
-        del release["identifiers"]
-    if "data_quality" in release:
-        del release["data_quality"]
+    for key in REMOVE_KEYS:
+        if key in release:
+            del release[key]
 
     # Simplify some fields.
     try:
@@ -48,8 +70,7 @@ def get_release(path, release):
         release["master_id"] = release["master_id"] if "master_id" in release else {}
     except:
         print("Error reading", json.dumps(release, indent=4))
-        errors += 1
-        return True
+        return None
 
     # Make each field a list
     if type(release["genres"]) is str:
@@ -123,40 +144,193 @@ def get_release(path, release):
 
     ##############
     # Cleanup done
+    return release
+
+
+def get_release(path, release):
+    global errors
+    global processed
+
+    release = preprocess_release(path, release)
+    if release is None:
+        errors += 1
+        return True
 
     # Write to file as a line-delimited json
-    json_f.write(json.dumps(release, ensure_ascii=False) + "\n")
+    json_f.write(dumps(release) + "\n")
 
     processed += 1
     if not processed % 50000:
         print(f"Processed {processed:>10,} releases")
+    if metrics is not None:
+        metrics.step()
+
+    if (
+        checkpoint_path is not None
+        and time.monotonic() - last_checkpoint > checkpoint_interval
+    ):
+        write_checkpoint()
     return True
 
 
-def main(xml_file, output_dir=None):
+def set_parser(parser):
+    global xml_parser
+    xml_parser = parser
+
+
+def write_checkpoint():
+    """Saves the position of the last written release in the xml and the
+    output files, together with the counters, so that the processing can be
+    resumed from there."""
+
+    global last_checkpoint
+
+    # Make sure that the output up to the checkpoint is on disk
+    json_f.flush()
+    os.fsync(json_f.fileno())
+    checkpoint = {
+        # The closing tag of the last written release
+        "input_offset": input_base + xml_parser.CurrentByteIndex,
+        "output_offset": json_f.tell(),
+        "processed": processed,
+        "errors": errors,
+    }
+    # Replace the previous checkpoint atomically
+    with open(checkpoint_path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+    last_checkpoint = time.monotonic()
+
+
+def process_shard(shard):
+    """Parses a byte range of the xml file and writes its releases to a shard
+    output file. Returns the number of processed and skipped releases."""
+
+    global json_f
+    global processed
+    global errors
+    global metrics
+
+    xml_file, start, end, shard_path, parser = shard
+    # The main process keeps the metrics of the shards
+    processed, errors, metrics = 0, 0, None
+    with open(shard_path, "w", encoding="utf-8") as json_f:
+        parse_xml(
+            read_xml_range(xml_file, start, end, "releases"),
+            get_release,
+            parser,
+            REMOVE_KEYS,
+        )
+    return processed, errors
+
+
+def parse_in_shards(xml_file, output_path, workers, parser):
+    """Splits the xml file into byte ranges aligned on <release> tags, parses
+    them with a pool of workers and merges the outputs in release order."""
+
+    global processed
+    global errors
+
+    # Use more shards than workers to balance the load
+    shards = split_xml_file(xml_file, "releases", "release", workers * 4)
+    shard_paths = [f"{output_path}.shard{i:04d}" for i in range(len(shards))]
+    print(f"Split the file into {len(shards):,} shards")
+
+    metrics = StageMetrics("preprocess_releases", xml_file, 0, 0)
+    with Pool(workers) as pool:
+        results = pool.imap(
+            process_shard,
+            [(xml_file, s, e, p, parser) for (s, e), p in zip(shards, shard_paths)],
+        )
+        for i, (shard_processed, shard_errors) in enumerate(results):
+            processed += shard_processed
+            errors += shard_errors
+            print(f"Processed {processed:>10,} releases ({i+1}/{len(shards)} shards)")
+            # The xml file is parsed up to the end of the shard
+            metrics.in_f = shards[i][1]
+            metrics.out_f += os.path.getsize(shard_paths[i])
+            metrics.step(shard_processed)
+    metrics.close()
+
+    # Put the shards together in the original order
+    merge_shards(shard_paths, output_path)
+
+
+def main(
+    xml_file,
+    output_dir=None,
+    workers=1,
+    parser="xmltodict",
+    decompressor="python",
+    resume=False,
+):
 
-    assert os.path.splitext(xml_file)[1] == ".xml", "Input file must be an xml file"
+    assert xml_file.endswith((".xml", ".xml.gz")), "Input file must be an xml file"
+    assert (
+        workers == 1 or not xml_file.endswith(".gz")
+    ), "Multiple workers require an uncompressed xml file"
+    assert workers == 1 or not resume, "Only a single worker can resume"
 
     # Write next to the xml file if no output_dir is specified
     if output_dir is None:
         output_dir = os.path.dirname(os.path.normpath(xml_file))
 
     # The output file will have the same name as the xml file but with .jsonl extension
-    output_path = os.path.join(output_dir, f"{os.path.basename(xml_file)}.jsonl")
+    output_path = os.path.join(output_dir, get_output_name(xml_file))
 
     # Ask the user whether to delete the existing file
-    if os.path.isfile(output_path):
+    if not resume and os.path.isfile(output_path):
         if input(f"{output_path} exists. Remove?[Y/n] ") == "n":
             output_path = input(f"New path?\n")
 
-    # Open the output file
-    global json_f
-    json_f = open(output_path, "w", encoding="utf-8")
-
     # Parse and main the xml file
     start_time = time.monotonic()
     print(f"Loading {xml_file}")
-    xmltodict.parse(open(xml_file, "rb"), item_depth=2, item_callback=get_release)
+    if workers > 1:
+        parse_in_shards(xml_file, output_path, workers, parser)
+    else:
+        global json_f
+        global processed
+        global errors
+        global checkpoint_path
+        global last_checkpoint
+        global input_base
+        global metrics
+
+        checkpoint_path = f"{output_path}.checkpoint"
+        last_checkpoint = time.monotonic()
+        if resume:
+            # Continue after the last release saved in the checkpoint
+            assert os.path.isfile(checkpoint_path), f"{checkpoint_path} not found"
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            processed, errors = checkpoint["processed"], checkpoint["errors"]
+            print(
+                f"Resuming after {processed:,} releases at byte "
+                f"{checkpoint['input_offset']:,} of the xml file"
+            )
+            # Drop the releases written after the checkpoint
+            json_f = open(output_path, "r+", encoding="utf-8")
+            json_f.truncate(checkpoint["output_offset"])
+            json_f.seek(checkpoint["output_offset"])
+        else:
+            json_f = open(output_path, "w", encoding="utf-8")
+
+        with open_xml(xml_file, decompressor) as xml_input:
+            metrics = StageMetrics("preprocess_releases", xml_file, xml_input, json_f)
+            if resume:
+                start, xml_input = skip_to_item(
+                    xml_input, checkpoint["input_offset"] + 1, "releases", "release"
+                )
+                # The parser input starts with the root tag before the release
+                input_base = start - len("<releases>")
+            parse_xml(xml_input, get_release, parser, REMOVE_KEYS, set_parser)
+            metrics.close()
+        # Close the json file
+        json_f.close()
+        # The processing is complete, there is nothing to resume
+        if os.path.isfile(checkpoint_path):
+            os.remove(checkpoint_path)
     print(f"Processed {processed:>10,} releases")
     print(f"{errors:>20,} releases skipped due to errors")
     print(
@@ -164,9 +338,6 @@ def main(xml_file, output_dir=None):
         f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-start_time))}"
     )
 
-    # Close the json file
-    json_f.close()
-
 
 if __name__ == "__main__":
 
@@ -174,7 +345,10 @@ if __name__ == "__main__":
         description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        "xml_file", type=str, default=None, help='Input XML "releases" dump file.'
+        "xml_file",
+        type=str,
+        default=None,
+        help='Input XML "releases" dump file. Can be gzip compressed (.xml.gz).',
     )
     parser.add_argument(
         "--output-dir",
@@ -185,10 +359,61 @@ if __name__ == "__main__":
         "If not specified, the output file will be stored"
         "next to the input file.",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes. If larger than 1, the file is split "
+        "into byte ranges that are parsed in parallel.",
+    )
+    parser.add_argument(
+        "--parser",
+        "-p",
+        type=str,
+        choices=PARSERS,
+        default="xmltodict",
+        help="XML parser backend. expat streams the file without building "
+        "the fields that are removed afterwards. The output is the same.",
+    )
+    parser.add_argument(
+        "--decompressor",
+        "-d",
+        type=str,
+        choices=DECOMPRESSORS,
+        default="python",
+        help="How to decompress .xml.gz files. thread decompresses in a "
+        "background thread and pigz uses an external pigz process, both run "
+        "alongside parsing.",
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        action="store_true",
+        help="Resume an interrupted run from its last checkpoint. The output "
+        "is truncated to the checkpoint and the parsing continues from the "
+        "next release.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        "-c",
+        type=int,
+        default=300,
+        help="Seconds between the checkpoints of a single worker run.",
+    )
     args = parser.parse_args()
 
+    checkpoint_interval = args.checkpoint_interval
+
     # Read the input xml, process and write to output_path
-    main(args.xml_file, args.output_dir)
+    main(
+        args.xml_file,
+        args.output_dir,
+        args.workers,
+        args.parser,
+        args.decompressor,
+        args.resume,
+    )
 
     #############
     print("Done!")
@@ -0,0 +1,223 @@
+"""Runs preprocess_releases_xml.py, clean_releases.py and
+parse_releases_to_tracks.py as a single streaming pass. Each release goes from
+the XML dump through the three stages in memory, so only the final .tracks file
+is written, without the large intermediary line-delimited JSON files. The
+output is the same as running the three scripts one after the other."""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from xml_utils import DECOMPRESSORS, get_output_name, open_xml, iter_items
+from preprocess_releases_xml import REMOVE_KEYS, preprocess_release
+from clean_releases import load_genre_tree, load_artist_ids, clean_release
+import clean_releases
+from parse_releases_to_tracks import format_tracks, TRACK_DROPS
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utilities.jsonl_io import open_jsonl, add_suffix, is_compressed
+from utilities.json_codec import dumps
+from utilities.metrics import StageMetrics
+from utilities.utils import print_text_cache_stats
+
+# Counters of each stage
+processed, errors = 0, 0
+r_cleaned, t_cleaned = 0, 0
+t_total = 0
+metrics = None
+
+
+def preprocessed_releases(xml_input, out_f=None):
+    """Yields the preprocessed releases of the XML dump. Writes them to out_f
+    if it is given."""
+
+    global processed
+    global errors
+
+    for path, release in iter_items(xml_input, 2, REMOVE_KEYS):
+        release = preprocess_release(path, release)
+        if release is None:
+            errors += 1
+            continue
+        if out_f is not None:
+            out_f.write(dumps(release) + "\n")
+        processed += 1
+        if not processed % 50000:
+            print(f"Processed {processed:>10,} releases")
+        if metrics is not None:
+            metrics.step()
+        yield release
+
+
+def cleaned_releases(releases, all_artist_ids, genre_tree, out_f=None):
+    """Yields the releases that remain after cleaning. Writes them to out_f if
+    it is given."""
+
+    global r_cleaned
+    global t_cleaned
+
+    for release in releases:
+        if not clean_release(release, all_artist_ids, genre_tree):
+            continue
+        if out_f is not None:
+            out_f.write(dumps(release) + "\n")
+        r_cleaned += 1
+        t_cleaned += len(release["tracklist"])
+        yield release
+
+
+def parsed_tracks(releases, all_artist_ids):
+    """Yields the tracks of the releases in the format for finding cliques."""
+
+    global t_total
+
+    for release in releases:
+        tracks = format_tracks(release, all_artist_ids)
+        t_total += len(tracks)
+        yield from tracks
+
+
+def main(
+    xml_file,
+    artists_json,
+    output_json=None,
+    materialize=False,
+    decompressor="python",
+    int_ids=False,
+):
+
+    assert xml_file.endswith((".xml", ".xml.gz")), "Input file must be an xml file"
+
+    # Same names as when running the stages one by one, next to the xml file
+    release_json = os.path.join(
+        os.path.dirname(os.path.normpath(xml_file)), get_output_name(xml_file)
+    )
+    if output_json is None:
+        output_json = add_suffix(add_suffix(release_json, ".clean"), ".tracks")
+        print(f"Tracks will be saved to: {output_json}")
+    # Create the parent directory if it does not exist
+    output_dir = os.path.dirname(output_json)
+    if output_dir != "":
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Ask the user whether to delete the existing file
+    if os.path.isfile(output_json):
+        if input(f"{output_json} exists. Remove?[Y/n] ") == "n":
+            output_json = input(f"New .json path?\n")
+
+    # The intermediary files are written next to the output file, compressed
+    # if the output file is compressed
+    if materialize:
+        release_json = os.path.join(output_dir, os.path.basename(release_json))
+        if is_compressed(output_json):
+            release_json += ".zst"
+        clean_json = add_suffix(release_json, ".clean")
+        print(f"Releases will be saved to: {release_json}")
+        print(f"Clean releases will be saved to: {clean_json}")
+
+    genre_tree = load_genre_tree()
+    print("Loading all artist ids...")
+    all_artist_ids = load_artist_ids(artists_json, int_ids)
+
+    global metrics
+
+    start_time = time.monotonic()
+    print(f"Loading {xml_file}")
+    with open_xml(xml_file, decompressor) as xml_input, open_jsonl(
+        output_json, "w"
+    ) as out_f:
+        metrics = StageMetrics(
+            "releases_xml_to_tracks",
+            xml_file,
+            xml_input,
+            out_f,
+            {
+                "clean_release": clean_releases.DROPS,
+                "format_tracks": TRACK_DROPS,
+            },
+        )
+        release_f = open_jsonl(release_json, "w") if materialize else None
+        clean_f = open_jsonl(clean_json, "w") if materialize else None
+
+        # Chain the stages, each release is pulled through all of them
+        releases = preprocessed_releases(xml_input, release_f)
+        releases = cleaned_releases(releases, all_artist_ids, genre_tree, clean_f)
+        for track in parsed_tracks(releases, all_artist_ids):
+            out_f.write(dumps(track) + "\n")
+        metrics.close()
+
+        if materialize:
+            release_f.close()
+            clean_f.close()
+
+    print(f"Processed {processed:>10,} releases")
+    print(f"{errors:>20,} releases skipped due to errors")
+    print(f"{r_cleaned:>10,} releases remain after cleaning.")
+    print(f"{t_cleaned:>10,} tracks remain after cleaning.")
+    print(f"{clean_releases.GENRE_TREE_ERRORS:>10,} genre-style matching errors found.")
+    print(f"Parsed {r_cleaned:>9,} releases to {t_total:>9,} tracks.")
+    print_text_cache_stats()
+    print(
+        "Total processing time: "
+        f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-start_time))}"
+    )
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "xml_file",
+        type=str,
+        help='Input XML "releases" dump file. Can be gzip compressed (.xml.gz).',
+    )
+    parser.add_argument(
+        "artists_json", type=str, help="Parsed artists.json.clean file."
+    )
+    parser.add_argument(
+        "--output-json",
+        "-o",
+        type=str,
+        default=None,
+        help="Output line-delimited JSON file with the tracks. If not "
+        "specified, it is stored next to the input file with the same name as "
+        "when running the stages one by one.",
+    )
+    parser.add_argument(
+        "--materialize",
+        "-m",
+        action="store_true",
+        help="Also write the preprocessed and the clean releases next to the "
+        "output file, as preprocess_releases_xml.py and clean_releases.py do.",
+    )
+    parser.add_argument(
+        "--decompressor",
+        "-d",
+        type=str,
+        choices=DECOMPRESSORS,
+        default="python",
+        help="How to decompress .xml.gz files.",
+    )
+    parser.add_argument(
+        "--int-ids",
+        "-i",
+        action="store_true",
+        help="Keep the artist ids as integers in memory, which uses less memory "
+        "and hashes faster. The output is the same.",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.xml_file,
+        args.artists_json,
+        args.output_json,
+        args.materialize,
+        args.decompressor,
+        args.int_ids,
+    )
+
+    #############
+    print("Done!")
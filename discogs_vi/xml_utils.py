@@ -0,0 +1,412 @@
+"""Helpers for reading the Discogs XML dumps. Contains the XML parser backends,
+the readers for the gzip compressed dumps and the functions to split a dump
+into byte-range shards so that it can be processed by multiple workers in
+parallel."""
+
+import os
+import gzip
+import queue
+import shutil
+import threading
+import subprocess
+from contextlib import contextmanager
+from xml.parsers import expat
+
+import xmltodict
+
+# Size of the blocks read from the XML file
+READ_SIZE = 2**24
+
+# Available parser backends
+PARSERS = ["xmltodict", "expat"]
+
+# Available ways of decompressing the .xml.gz dumps
+DECOMPRESSORS = ["python", "thread", "pigz"]
+
+
+def get_output_name(xml_file):
+    """Returns the name of the preprocessed file for the dump, e.g.
+    discogs_20240701_releases.xml(.gz) -> discogs_20240701_releases.xml.jsonl"""
+
+    name = os.path.basename(xml_file)
+    if name.endswith(".gz"):
+        name = name[: -len(".gz")]
+    return f"{name}.jsonl"
+
+
+def _threaded_reader(f):
+    """Yields the blocks of f that are read by a background thread. zlib
+    releases the GIL, so decompression runs alongside parsing."""
+
+    blocks = queue.Queue(maxsize=4)
+
+    def read():
+        try:
+            for block in iter(lambda: f.read(READ_SIZE), b""):
+                blocks.put(block)
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        block = blocks.get()
+        if block is None:
+            break
+        if isinstance(block, Exception):
+            raise block
+        yield block
+
+
+@contextmanager
+def open_xml(xml_file, decompressor="python"):
+    """Opens a .xml or a .xml.gz dump for parsing. Yields a binary file object
+    or a generator of bytes. For the .xml.gz files the decompressor can be
+    python (gzip module, in the parsing thread), thread (gzip module, in a
+    background thread) or pigz (external pigz process)."""
+
+    assert xml_file.endswith((".xml", ".xml.gz")), "Input file must be an xml file"
+
+    if xml_file.endswith(".xml"):
+        with open(xml_file, "rb") as f:
+            yield f
+    elif decompressor == "python":
+        with gzip.open(xml_file, "rb") as f:
+            yield f
+    elif decompressor == "thread":
+        with gzip.open(xml_file, "rb") as f:
+            yield _threaded_reader(f)
+    elif decompressor == "pigz":
+        assert shutil.which("pigz") is not None, "pigz is not installed"
+        proc = subprocess.Popen(
+            ["pigz", "-dc", xml_file], stdout=subprocess.PIPE, bufsize=READ_SIZE
+        )
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        assert proc.returncode == 0, f"pigz failed with code {proc.returncode}"
+    else:
+        raise ValueError(f"Unknown decompressor: {decompressor}")
+
+
+def _find_next(f, offset, pattern, limit):
+    """Returns the position of the first occurrence of pattern at or after
+    offset. Returns limit if the pattern is not found before it."""
+
+    f.seek(offset)
+    buffer, buffer_start = b"", offset
+    while buffer_start + len(buffer) < limit:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        i = buffer.find(pattern)
+        if i != -1:
+            return min(buffer_start + i, limit)
+        # Keep the tail in case the pattern is split between two chunks
+        keep = min(len(pattern) - 1, len(buffer))
+        buffer_start += len(buffer) - keep
+        buffer = buffer[len(buffer) - keep :]
+    return limit
+
+
+def _find_last(f, file_size, pattern):
+    """Returns the position of the last occurrence of pattern in the file."""
+
+    f.seek(max(0, file_size - READ_SIZE))
+    tail = f.read()
+    i = tail.rfind(pattern)
+    assert i != -1, f"Could not find {pattern.decode()} in the file"
+    return file_size - len(tail) + i
+
+
+def split_xml_file(xml_file, root_tag, item_tag, n_shards):
+    """Splits the XML file into at most n_shards byte ranges. Each range starts
+    at an <item_tag> opening tag and contains only complete items, so that it
+    can be parsed on its own after wrapping it with the root tag. Returns a
+    list of (start, end) tuples in file order."""
+
+    # Items with attributes (<release id="1">) or without (<artist>)
+    item_patterns = [f"<{item_tag} ".encode(), f"<{item_tag}>".encode()]
+
+    file_size = os.path.getsize(xml_file)
+    with open(xml_file, "rb") as f:
+        # The items are between the opening and closing root tags
+        data_end = _find_last(f, file_size, f"</{root_tag}>".encode())
+        data_start = min(_find_next(f, 0, p, data_end) for p in item_patterns)
+
+        # Move each approximate boundary to the start of the next item
+        boundaries = [data_start]
+        for i in range(1, n_shards):
+            offset = data_start + i * (data_end - data_start) // n_shards
+            boundary = min(_find_next(f, offset, p, data_end) for p in item_patterns)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        if data_end > boundaries[-1]:
+            boundaries.append(data_end)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_xml_range(xml_file, start, end, root_tag):
+    """Yields the bytes between start and end wrapped with the root tag, as a
+    stand-alone XML document."""
+
+    yield f"<{root_tag}>".encode()
+    with open(xml_file, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    yield f"</{root_tag}>".encode()
+
+
+def merge_shards(shard_paths, output_path):
+    """Concatenates the shard outputs in order to output_path and deletes them."""
+
+    with open(output_path, "wb") as out_f:
+        for shard_path in shard_paths:
+            with open(shard_path, "rb") as in_f:
+                shutil.copyfileobj(in_f, out_f, READ_SIZE)
+            os.remove(shard_path)
+
+
+class _StreamingHandler:
+    """Builds the same item dictionaries as xmltodict with its default options
+    but never builds the children of an item whose name is in skip_keys. The
+    characters of the skipped subtrees are not even passed to Python."""
+
+    def __init__(self, parser, item_depth, item_callback, skip_keys):
+        self.parser = parser
+        self.item_depth = item_depth
+        self.item_callback = item_callback
+        self.skip_keys = frozenset(skip_keys)
+        self.path = []
+        self.stack = []
+        self.data = []
+        self.item = None
+        self.skip_level = 0
+
+    def start_element(self, name, attrs):
+        # Skip the subtree of the unnecessary children of an item
+        if len(self.path) == self.item_depth and name in self.skip_keys:
+            self.skip_level = 1
+            self.parser.StartElementHandler = self.start_skipped
+            self.parser.EndElementHandler = self.end_skipped
+            self.parser.CharacterDataHandler = None
+            self.parser.DefaultHandler = None
+            return
+
+        attrs = dict(zip(attrs[0::2], attrs[1::2]))
+        self.path.append((name, attrs or None))
+        if len(self.path) > self.item_depth:
+            self.stack.append((self.item, self.data))
+            self.item = {"@" + key: value for key, value in attrs.items()} or None
+            self.data = []
+
+    def end_element(self, name):
+        if len(self.path) == self.item_depth:
+            item = self.item
+            if item is None:
+                item = None if not self.data else "".join(self.data)
+            if not self.item_callback(self.path, item):
+                raise xmltodict.ParsingInterrupted()
+        if self.stack:
+            data = None if not self.data else "".join(self.data)
+            item = self.item
+            self.item, self.data = self.stack.pop()
+            if data:
+                data = data.strip() or None
+            if item is not None:
+                if data:
+                    self.push_data(item, "#text", data)
+                self.item = self.push_data(self.item, name, item)
+            else:
+                self.item = self.push_data(self.item, name, data)
+        else:
+            self.item = None
+            self.data = []
+        self.path.pop()
+
+    def characters(self, data):
+        self.data.append(data)
+
+    def default(self, data):
+        pass
+
+    def start_skipped(self, name, attrs):
+        self.skip_level += 1
+
+    def end_skipped(self, name):
+        self.skip_level -= 1
+        if not self.skip_level:
+            self.parser.StartElementHandler = self.start_element
+            self.parser.EndElementHandler = self.end_element
+            self.parser.CharacterDataHandler = self.characters
+            self.parser.DefaultHandler = self.default
+
+    @staticmethod
+    def push_data(item, key, data):
+        if item is None:
+            item = {}
+        if key in item:
+            value = item[key]
+            if isinstance(value, list):
+                value.append(data)
+            else:
+                item[key] = [value, data]
+        else:
+            item[key] = data
+        return item
+
+
+def _create_parser(item_depth, item_callback, skip_keys):
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    # Do not expand entities, same as xmltodict
+    parser.ExternalEntityRefHandler = lambda *x: 1
+
+    handler = _StreamingHandler(parser, item_depth, item_callback, skip_keys)
+    parser.DefaultHandler = handler.default
+    parser.StartElementHandler = handler.start_element
+    parser.EndElementHandler = handler.end_element
+    parser.CharacterDataHandler = handler.characters
+    return parser
+
+
+def parse_items(xml_input, item_depth, item_callback, skip_keys=(), on_parser=None):
+    """Streams the items at item_depth to item_callback like xmltodict.parse
+    does, using expat directly. The children of the items whose names are in
+    skip_keys are skipped without being built. xml_input can be a binary file
+    object or a generator of bytes. on_parser is called with the expat parser
+    before parsing starts."""
+
+    parser = _create_parser(item_depth, item_callback, skip_keys)
+    if on_parser is not None:
+        on_parser(parser)
+    if hasattr(xml_input, "read"):
+        parser.ParseFile(xml_input)
+    else:
+        for chunk in xml_input:
+            parser.Parse(chunk, False)
+        parser.Parse(b"", True)
+
+
+def iter_items(xml_input, item_depth=2, skip_keys=(), read_size=2**20):
+    """Generator version of parse_items. Yields (path, item) tuples, where path
+    is a copy of the path of the item, so that the items can be pulled through
+    a chain of generators instead of being pushed to a callback."""
+
+    items = []
+
+    def item_callback(path, item):
+        items.append((list(path), item))
+        return True
+
+    if hasattr(xml_input, "read"):
+        f = xml_input
+        xml_input = iter(lambda: f.read(read_size), b"")
+
+    parser = _create_parser(item_depth, item_callback, skip_keys)
+    for chunk in xml_input:
+        parser.Parse(chunk, False)
+        yield from items
+        items.clear()
+    parser.Parse(b"", True)
+    yield from items
+
+
+class _ParserHook:
+    """Stands in for the expat module in xmltodict.parse and passes the parser
+    it creates to on_parser."""
+
+    def __init__(self, on_parser):
+        self.on_parser = on_parser
+
+    def ParserCreate(self, *args, **kwargs):
+        parser = expat.ParserCreate(*args, **kwargs)
+        self.on_parser(parser)
+        return parser
+
+    def __getattr__(self, name):
+        return getattr(expat, name)
+
+
+def parse_xml(
+    xml_input, item_callback, parser="xmltodict", skip_keys=(), on_parser=None
+):
+    """Calls item_callback(path, item) for each item of a Discogs dump, i.e.
+    each <release> or <artist>. With the expat parser the children listed in
+    skip_keys are not included in the items, otherwise the items are the same.
+    on_parser is called with the underlying expat parser, e.g. to read its
+    CurrentByteIndex from item_callback."""
+
+    if parser == "xmltodict":
+        xmltodict.parse(
+            xml_input,
+            expat=expat if on_parser is None else _ParserHook(on_parser),
+            item_depth=2,
+            item_callback=item_callback,
+        )
+    elif parser == "expat":
+        parse_items(xml_input, 2, item_callback, skip_keys, on_parser)
+    else:
+        raise ValueError(f"Unknown parser: {parser}")
+
+
+def skip_to_item(xml_input, offset, root_tag, item_tag):
+    """Skips the first offset bytes of xml_input, a binary file object or a
+    generator of bytes, up to the next <item_tag>. Used for resuming the
+    parsing from a byte offset. Returns the position of that item in
+    xml_input and a generator of the bytes starting at the item wrapped with
+    the opening root tag, as a stand-alone XML document."""
+
+    if hasattr(xml_input, "read"):
+        f = xml_input
+        xml_input = iter(lambda: f.read(READ_SIZE), b"")
+        if f.seekable():
+            f.seek(offset)
+            position = offset
+        else:
+            position = 0
+    else:
+        position = 0
+
+    # Drop the bytes before the offset and before the next item
+    patterns = [f"<{item_tag} ".encode(), f"<{item_tag}>".encode()]
+    keep = len(patterns[0]) - 1
+    buffer = b""
+    for chunk in xml_input:
+        if position + len(chunk) <= offset:
+            position += len(chunk)
+            continue
+        if position < offset:
+            chunk = chunk[offset - position :]
+            position = offset
+        # buffer starts at position
+        buffer += chunk
+        starts = [i for i in (buffer.find(p) for p in patterns) if i != -1]
+        if starts:
+            position += min(starts)
+            buffer = buffer[min(starts) :]
+            break
+        # Keep the tail in case the pattern is split between two chunks
+        position += max(len(buffer) - keep, 0)
+        buffer = buffer[-keep:]
+    else:
+        # No items after the offset, only the closing root tag is left
+        buffer = f"</{root_tag}>".encode()
+
+    def read():
+        yield f"<{root_tag}>".encode()
+        yield buffer
+        yield from xml_input
+
+    return position, read()
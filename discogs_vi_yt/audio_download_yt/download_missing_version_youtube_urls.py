@@ -5,7 +5,6 @@ highest quality match."""
 import os
 import sys
 import csv
-import json
 import time
 import argparse
 
@@ -15,18 +14,29 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from query_yt.utils_query import get_youtube_id
 
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+from utilities.records import Clique
+from utilities.release_table import load_release_table
+
 
 def main(input_json, music_dir, force_failed=False):
 
+    # The release table of normalized cliques, if there is one
+    releases = load_release_table(input_json)
+
     print("Downloading the missing YouTube IDs of the matched versions...")
     t0 = time.monotonic()
     counter, success = 0, 0
-    with open(input_json, encoding="utf-8") as in_f, open(
+    with open_jsonl(input_json) as in_f, open(
         input_json + ".log", "w"
     ) as logfile:
         logger = csv.writer(logfile, delimiter="\t")
         for jsonline in in_f:
-            clique = json.loads(jsonline)
+            clique = Clique.from_dict(loads(jsonline), releases)
             for version in clique["versions"]:
                 # Download the first video that is not downloaded yet
                 # The videos were sorted by match quality before
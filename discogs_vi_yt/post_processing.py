@@ -1,15 +1,23 @@
 """This script filters out the versions that do not have a downloaded Youtube 
 video from the versions.json file to finalize the Discogs-VI-YT dataset. It also 
 filters out the cliques that have only one version left. Also it keeps only one 
-version per youtube_id. The output is written to a new .json file."""
+version per youtube_id. The output is written to a new .json file. If the
+input cliques are normalized, the release fields are joined to their tracks."""
 
 import os
+import sys
 import json
 from collections import defaultdict, Counter
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
 from query_yt.utils_query import get_youtube_id, count_version_video_matches
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads, dumps
+from utilities.records import Clique
+from utilities.release_table import load_release_table, join_releases
+
 if __name__ == "__main__":
 
     parser = ArgumentParser(
@@ -61,13 +69,16 @@ if __name__ == "__main__":
         if not os.path.exists(video_dir):
             raise FileNotFoundError(f"{video_dir} does not exist.")
 
+    # The release table of normalized cliques, if there is one
+    releases = load_release_table(args.input_json)
+
     # For each version, delete the videos that were not downloaded
     n_cliques, n_versions = 0, 0
-    with open(args.input_json, encoding="utf-8") as in_f, open(
+    with open_jsonl(args.input_json) as in_f, open(
         args.output_json, "w", encoding="utf-8"
     ) as out_f:
         for jsonline in in_f:
-            clique = json.loads(jsonline)
+            clique = Clique.from_dict(loads(jsonline), releases)
 
             for version in clique["versions"]:
                 _videos = []
@@ -108,8 +119,10 @@ if __name__ == "__main__":
             if len(clique["versions"]) < 2:
                 continue
 
-            # Write the clique to the output file
-            out_f.write(json.dumps(clique, ensure_ascii=False) + "\n")
+            # Write the clique to the output file, with the release fields
+            if releases is not None:
+                join_releases(clique)
+            out_f.write(dumps(clique) + "\n")
             n_cliques += 1
             n_versions += len(clique["versions"])
 
@@ -8,7 +8,7 @@ sys.path.append(
         os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     )
 )
-from utilities.utils import soft_clean_text
+from utilities.utils import soft_clean_text, memoize_text
 
 EXCLUDE_TITLES = {"full album"}
 
@@ -32,6 +32,7 @@ def wrap_in_brackets(s):
 ##################################### Cleaning Methods #####################################
 
 
+@memoize_text
 def clean_uploader_name(v_uploader):
     """Cleans the uploader name (channel) from unnecessary information. Returns the cleaned
     uploader name."""
@@ -3,11 +3,19 @@ unique youtube queries (for the format of the query string see create_query_stri
 for all the tracks."""
 
 import os
-import json
+import sys
 import argparse
 
 from lib import create_query_string
 
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+from utilities.records import Clique
+from utilities.release_table import load_release_table
+
 
 def main(input_json, output_txt=None):
 
@@ -25,13 +33,16 @@ def main(input_json, output_txt=None):
     if output_dir != "":
         os.makedirs(output_dir, exist_ok=True)
 
+    # The release table of normalized cliques, if there is one
+    releases = load_release_table(input_json)
+
     # Load the data
     total_queries = 0
-    with open(input_json, encoding="utf-8") as in_f, open(
-        output_txt, "w", encoding="utf-8"
-    ) as out_f:
+    with open_jsonl(input_json) as in_f, open(output_txt, "w", encoding="utf-8") as out_f:
         for jline in in_f:
-            versioned_clique = json.loads(jline)
+            versioned_clique = loads(jline)
+            if releases is not None:
+                versioned_clique = Clique.from_dict(versioned_clique, releases)
             for version in versioned_clique["versions"]:
                 queries = set()
                 # If the version is not matched to a youtube video before
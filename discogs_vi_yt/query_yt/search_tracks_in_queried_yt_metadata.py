@@ -4,9 +4,10 @@ tries to find it in downloaded metadata inside metadata_dir. The metadata should
 downloaded with youtube_search_and_download_metadata.py"""
 
 import os
-import json
+import sys
 import time
 import csv
+import shutil
 import argparse
 
 from utils_query import (
@@ -20,6 +21,15 @@ from lib import (
     compare_video_metadata_with_track_metadata,
 )
 
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+from utilities.jsonl_io import open_jsonl, add_suffix
+from utilities.json_codec import loads, dumps
+from utilities.records import Clique
+from utilities.release_table import get_release_table_path, load_release_table
+from utilities.utils import print_text_cache_stats
+
 
 def main(input_json, metadata_dir, output_json=None, dont_count=False):
     """Read the versioned cliques and for the versions that were not matched to a
@@ -28,7 +38,7 @@ def main(input_json, metadata_dir, output_json=None, dont_count=False):
 
     # Determine the output path
     if output_json is None:
-        output_json = input_json + ".youtube_query_matched"
+        output_json = add_suffix(input_json, ".youtube_query_matched")
         print(f"Cliques will be saved to: {output_json}")
     # Check the output path for not over-writing
     if os.path.exists(output_json):
@@ -56,17 +66,25 @@ def main(input_json, metadata_dir, output_json=None, dont_count=False):
     mapping_path = os.path.join(metadata_dir, "query_id-mapping.json")
     with open(mapping_path, encoding="utf-8") as meta_file:
         for jline in meta_file:
-            metadata = json.loads(jline)
+            metadata = loads(jline)
             mapping_dict[metadata["query"]] = metadata["uuid"]
 
+    # The release table of normalized cliques, if there is one
+    releases = load_release_table(input_json)
+    if releases is not None:
+        # The matched cliques keep the same releases
+        shutil.copyfile(
+            get_release_table_path(input_json), get_release_table_path(output_json)
+        )
+
     print(
         "Searching for matches between versions and Youtube URLs using downloaded metadata."
     )
     print("=" * 75)
     t, t0, n_cliques = 0, time.monotonic(), 0
-    with open(input_json, encoding="utf-8") as in_f:
+    with open_jsonl(input_json) as in_f, open_jsonl(output_json, "a") as o_file:
         for jsonline in in_f:
-            versioned_clique = json.loads(jsonline)
+            versioned_clique = Clique.from_dict(loads(jsonline), releases)
 
             # For each version in the clique, check if any track's youtube metadata was downloaded
             for version in versioned_clique["versions"]:
@@ -89,7 +107,7 @@ def main(input_json, metadata_dir, output_json=None, dont_count=False):
                         metadata_dir, uuid[:2], uuid + ".json"
                     )
                     with open(search_results_path, encoding="utf-8") as meta_file:
-                        search_results = json.load(meta_file)
+                        search_results = loads(meta_file.read())
                     # Process the track metadata
                     t_title, t_artists, t_feat_artists = prepare_track_for_matching(
                         track
@@ -141,8 +159,7 @@ def main(input_json, metadata_dir, output_json=None, dont_count=False):
                 # Sort the videos by match quality
                 version["youtube_video"].sort(key=lambda x: int(x["match_type"]))
             # Write the updated clique
-            with open(output_json, "a", encoding="utf-8") as o_file:
-                o_file.write(json.dumps(versioned_clique, ensure_ascii=False) + "\n")
+            o_file.write(dumps(versioned_clique) + "\n")
             # Display progress
             n_cliques += 1
             if not n_cliques % 10000:
@@ -159,6 +176,7 @@ def main(input_json, metadata_dir, output_json=None, dont_count=False):
     print(f"Searched {n_cliques:>7,} cliques in downloaded metadata. [{time_str}]")
     if not dont_count:
         count_version_video_matches(output_json)
+    print_text_cache_stats()
     print(f"Total Processing time: {time.strftime('%H:%M:%S', time.gmtime(t))}")
     print("Finished the search.")
     print(f"Cliques are saved to: {output_json}")
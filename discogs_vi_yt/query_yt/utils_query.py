@@ -1,7 +1,14 @@
+import os
 import re
-import json
+import sys
 from collections import Counter
 
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+
 ######################################### Path Functions #########################################
 
 
@@ -75,9 +82,9 @@ def count_version_video_matches(videos_json):
     total_v_matches, total_c_matches = 0, 0
     c2_matches, c3_matches, c4_matches, c5_matches = 0, 0, 0, 0
     match_type_counter = Counter()
-    with open(videos_json, "r", encoding="utf-8") as in_f:
+    with open_jsonl(videos_json) as in_f:
         for jsonline in in_f:
-            clique = json.loads(jsonline)
+            clique = loads(jsonline)
             clique_yt_ids = set()  # Collect unique YT ids for this clique
             clique_v_counter = 0  # Version counter for this clique
             for version in clique["versions"]:
@@ -0,0 +1,345 @@
+"""Prepares the Discogs-VI dataset from a monthly Discogs dump, like
+prepare_discogs_vi.sh, but runs the stages that do not depend on each other
+concurrently. The artist and the release dumps are preprocessed at the same
+time and the artists are cleaned while the releases are still preprocessed.
+
+With --stream, the intermediary files that are read only once and
+sequentially are not written to disk. They are created as named pipes instead,
+so each stage consumes the output of the previous one while it is produced.
+Only the files whose reader can start together with their writer are
+streamed, see get_streamed_files. --dry-run prints the schedule."""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+from collections import namedtuple
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A stage of the pipeline. streamed_inputs are the inputs that the stage reads
+# only once, from start to end, so that they can be a named pipe.
+Stage = namedtuple(
+    "Stage", ["name", "script", "args", "inputs", "outputs", "streamed_inputs"]
+)
+
+
+def get_stages(release_xml, artist_xml, preprocess=True, int_ids=False):
+    """Returns the stages of the pipeline with the same file names as
+    prepare_discogs_vi.sh. With int_ids the stages that load the artist ids
+    keep them as integers."""
+
+    # The dumps can be gzip compressed, the outputs are named after the .xml file
+    release = release_xml.removesuffix(".gz") + ".jsonl"
+    artist = artist_xml.removesuffix(".gz") + ".jsonl"
+    clean_artist = f"{artist}.clean"
+    clean_release = f"{release}.clean"
+    tracks = f"{clean_release}.tracks"
+    # Same name as clique_finder.py uses by default
+    dump_date = tracks.split("_releases.xml")[0].split("/")[-1].split("discogs_")[-1]
+    cliques = os.path.join(os.path.dirname(tracks), f"Discogs-VI-{dump_date}.jsonl")
+    id_args = ["--int-ids"] if int_ids else []
+
+    stages = []
+    if preprocess:
+        stages += [
+            Stage(
+                "preprocess_artists",
+                "discogs_vi/preprocess_artists_xml.py",
+                [artist_xml],
+                [artist_xml],
+                [artist],
+                [],
+            ),
+            Stage(
+                "preprocess_releases",
+                "discogs_vi/preprocess_releases_xml.py",
+                [release_xml],
+                [release_xml],
+                [release],
+                [],
+            ),
+        ]
+    stages += [
+        # Reads the artists once, from start to end
+        Stage(
+            "clean_artists",
+            "discogs_vi/clean_artists.py",
+            [artist],
+            [artist],
+            [clean_artist],
+            [artist],
+        ),
+        Stage(
+            "clean_releases",
+            "discogs_vi/clean_releases.py",
+            [release, clean_artist] + id_args,
+            [release, clean_artist],
+            [clean_release],
+            [release],
+        ),
+        Stage(
+            "parse_releases_to_tracks",
+            "discogs_vi/parse_releases_to_tracks.py",
+            [clean_release, clean_artist] + id_args,
+            [clean_release, clean_artist],
+            [tracks],
+            [clean_release],
+        ),
+        Stage(
+            "clique_finder",
+            "discogs_vi/clique_finder.py",
+            [tracks, clean_artist, "-o", cliques] + id_args,
+            [tracks, clean_artist],
+            [cliques],
+            [tracks],
+        ),
+    ]
+    return stages
+
+
+def get_streamed_files(stages):
+    """Returns the files that can be named pipes: they are produced by a stage
+    of the pipeline and read by a single stage, sequentially, that can start
+    together with the producer. A producer blocks on its pipe until the
+    consumer opens it, so if the consumer had to wait for another stage that
+    is not finished when the producer starts, the producer would not run
+    alongside that stage. These files are written to disk instead. The stages
+    must be in order, each after the producers of its inputs."""
+
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    # The stages that are finished when each stage starts
+    finished = {}
+    streamed = set()
+    for stage in stages:
+        for path in stage.streamed_inputs:
+            consumers = [s for s in stages if path in s.inputs]
+            if path not in producers or len(consumers) != 1:
+                continue
+            others = {
+                producers[other]
+                for other in stage.inputs
+                if other in producers and other != path
+            }
+            if others <= finished[producers[path]]:
+                streamed.add(path)
+        finished[stage.name] = set()
+        for path in stage.inputs:
+            if path in producers and path not in streamed:
+                finished[stage.name].add(producers[path])
+                finished[stage.name].update(finished[producers[path]])
+    return streamed
+
+
+def get_dependencies(stages, streamed):
+    """Returns the names of the stages that must finish before each stage can
+    start. The producer of a streamed input runs alongside its consumer."""
+
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    dependencies = {}
+    for stage in stages:
+        dependencies[stage.name] = {
+            producers[path]
+            for path in stage.inputs
+            if path in producers and path not in streamed
+        }
+    return dependencies
+
+
+def print_schedule(stages, streamed):
+    """Prints when each stage starts and the files that are streamed."""
+
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    dependencies = get_dependencies(stages, streamed)
+    for stage in stages:
+        if dependencies[stage.name]:
+            after = ", ".join(sorted(dependencies[stage.name]))
+            print(f"{stage.name} starts after {after}")
+        else:
+            print(f"{stage.name} starts immediately")
+        for path in stage.inputs:
+            if path in streamed:
+                print(f"    streams {path} from {producers[path]}")
+            elif path in producers:
+                print(f"    reads {path} from disk")
+
+
+def _print_output(name, proc):
+    """Prints the output of a stage prefixed with its name."""
+
+    for line in proc.stdout:
+        print(f"[{name}] {line}", end="", flush=True)
+
+
+def run_stages(stages, streamed, metrics_path=None):
+    """Runs each stage as soon as the stages it depends on are finished.
+    Returns the exit code of the first failed stage or 0."""
+
+    env = dict(os.environ)
+    if metrics_path is not None:
+        # The stages append their metrics to the same file
+        env["DISCOGS_VI_METRICS"] = os.path.abspath(metrics_path)
+
+    dependencies = get_dependencies(stages, streamed)
+    pending = list(stages)
+    running, done = {}, set()
+    start_times = {}
+    returncode = 0
+    while pending or running:
+        # Start the stages whose dependencies are finished
+        for stage in [s for s in pending if dependencies[s.name] <= done]:
+            print(f"Starting {stage.name}")
+            proc = subprocess.Popen(
+                [sys.executable, "-u", stage.script] + stage.args,
+                cwd=REPO_DIR,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                env=env,
+            )
+            thread = threading.Thread(target=_print_output, args=(stage.name, proc))
+            thread.start()
+            running[stage.name] = (proc, thread)
+            start_times[stage.name] = time.monotonic()
+            pending.remove(stage)
+
+        time.sleep(0.1)
+        for name, (proc, thread) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            thread.join()
+            del running[name]
+            elapsed = time.monotonic() - start_times[name]
+            print(
+                f"Finished {name} with code {proc.returncode} in "
+                f"{time.strftime('%H:%M:%S', time.gmtime(elapsed))}"
+            )
+            if proc.returncode != 0:
+                returncode = proc.returncode
+            else:
+                done.add(name)
+
+        # Stop everything if a stage failed, the others may wait on its pipes
+        if returncode != 0:
+            for proc, thread in running.values():
+                proc.kill()
+                proc.wait()
+                thread.join()
+            break
+    return returncode
+
+
+def main(
+    release_xml,
+    artist_xml,
+    preprocess=True,
+    stream=False,
+    metrics_path=None,
+    int_ids=False,
+    dry_run=False,
+):
+
+    # The stages run from the repository directory
+    release_xml = os.path.abspath(release_xml)
+    artist_xml = os.path.abspath(artist_xml)
+
+    stages = get_stages(release_xml, artist_xml, preprocess, int_ids)
+    streamed = get_streamed_files(stages) if stream else set()
+    for path in streamed:
+        assert not path.endswith(".zst"), "Compressed files can not be streamed"
+    if dry_run:
+        print_schedule(stages, streamed)
+        return
+
+    # Ask once instead of letting each stage ask while running in the background
+    outputs = [path for stage in stages for path in stage.outputs]
+    existing = [path for path in outputs if os.path.exists(path)]
+    if existing:
+        print("\n".join(existing))
+        if input("These files exist. Remove?[Y/n] ") == "n":
+            sys.exit("Not overwriting the existing files.")
+        for path in existing:
+            os.remove(path)
+
+    for path in sorted(streamed):
+        print(f"Streaming {path}")
+        os.mkfifo(path)
+
+    start_time = time.monotonic()
+    try:
+        returncode = run_stages(stages, streamed, metrics_path)
+    finally:
+        for path in streamed:
+            if os.path.exists(path):
+                os.remove(path)
+    print(
+        "Total processing time: "
+        f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-start_time))}"
+    )
+    if returncode != 0:
+        sys.exit(returncode)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "release_xml", type=str, help='XML "releases" dump, can be .xml.gz.'
+    )
+    parser.add_argument(
+        "artist_xml", type=str, help='XML "artists" dump, can be .xml.gz.'
+    )
+    parser.add_argument(
+        "--skip-preprocess",
+        action="store_true",
+        help="Skip preprocessing the xml files, if they were preprocessed before.",
+    )
+    parser.add_argument(
+        "--stream",
+        "-s",
+        action="store_true",
+        help="Pass the files that are read sequentially from stage to stage "
+        "through named pipes, without writing them to disk.",
+    )
+    parser.add_argument(
+        "--metrics",
+        "-m",
+        type=str,
+        default=None,
+        help="Line-delimited JSON file where the stages append their "
+        "throughput and resource metrics.",
+    )
+    parser.add_argument(
+        "--int-ids",
+        "-i",
+        action="store_true",
+        help="Keep the artist ids as integers in memory in the stages that "
+        "load them. The output is the same.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        "-n",
+        action="store_true",
+        help="Print when each stage would start and which files would be "
+        "streamed, without running them.",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.release_xml,
+        args.artist_xml,
+        not args.skip_preprocess,
+        args.stream,
+        args.metrics,
+        args.int_ids,
+        args.dry_run,
+    )
+
+    #############
+    if not args.dry_run:
+        print("Metadata preparation complete.")
@@ -19,8 +19,9 @@ fi
 release_xml=$1
 artist_xml=$2
 
-release="$release_xml.jsonl"
-artist="$artist_xml.jsonl"
+# The dumps can be gzip compressed, the outputs are named after the .xml file
+release="${release_xml%.gz}.jsonl"
+artist="${artist_xml%.gz}.jsonl"
 
 clean_artist="$artist.clean"
 clean_release="$release.clean"
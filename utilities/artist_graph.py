@@ -0,0 +1,351 @@
+"""Artist relations of the artists.jsonl.clean file stored as arrays.
+
+The artist ids are kept in a sorted int32 array and each relation (aliases,
+members, groups and namevariations_id) in compressed sparse row (CSR) form: an
+offsets array with one entry per artist plus one, and an indices array with the
+positions of the related artists in the ids array. The related artists of the
+artist at position i are indices[offsets[i] : offsets[i + 1]]. The artists that
+utilities.utils.collect_all_related_artists collects for each artist, its
+aliases, members, their aliases and so on, are kept in the same form as well,
+so that they are looked up instead of collected, see related_closures.
+
+The arrays are saved as .npy files in a directory and loaded memory-mapped, so
+loading takes milliseconds, only the pages that are used are read and the pages
+are shared by all the processes that load the same graph. clean_artists.py
+saves the graph of its output next to it, with the signature of the output
+file, and the later stages load it instead of parsing the artists file as long
+as the file does not change.
+
+ArtistGraph can be used in place of the artists dictionary of clique_finder.py,
+e.g. with utilities.utils.collect_all_related_artists:
+
+    python utilities/artist_graph.py discogs_20240701_artists.xml.jsonl.clean
+    graph = load_artist_graph("discogs_20240701_artists.xml.jsonl.clean.graph")
+    "aliases" in graph["123"], graph["123"].get("aliases", [])"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from array import array
+from itertools import repeat
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+
+RELATIONS = ("aliases", "members", "groups", "namevariations_id")
+
+# The artists collected by collect_all_related_artists for an artist are the
+# ones reached through every prefix of these paths of relations
+CLOSURE_PATHS = (
+    ("aliases", "members", "aliases"),
+    ("members", "aliases"),
+    ("namevariations_id", "aliases"),
+)
+
+# Bytes read from the start and the end of the artists file for its signature
+SIGNATURE_BYTES = 2**20
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def get_graph_dir(artists_json):
+    """Returns the default graph directory of an artists file."""
+    return f"{artists_json}.graph"
+
+
+class ArtistRelations:
+    """The relations of a single artist, with the interface of the artist
+    dictionaries of artists.jsonl.clean: the relations without related artists
+    are missing and the related artists are string ids, or ints if the graph
+    was loaded with int_ids."""
+
+    __slots__ = ("graph", "index")
+
+    def __init__(self, graph, index):
+        self.graph = graph
+        self.index = index
+
+    def related(self, relation):
+        """Returns the positions of the related artists in the ids array."""
+        offsets, indices = self.graph.relations[relation]
+        return indices[offsets[self.index] : offsets[self.index + 1]]
+
+    def __contains__(self, relation):
+        offsets, _ = self.graph.relations[relation]
+        return offsets[self.index + 1] > offsets[self.index]
+
+    def __getitem__(self, relation):
+        related = self.related(relation)
+        if not len(related):
+            raise KeyError(relation)
+        return self.graph.to_ids(related)
+
+    def get(self, relation, default=None):
+        related = self.related(relation)
+        if not len(related):
+            return default
+        return self.graph.to_ids(related)
+
+
+class ArtistGraph:
+    """Mapping of string artist ids to their ArtistRelations. With int_ids the
+    related artists are returned as ints, as in the int id mode of
+    clique_finder.py. closures are the (offsets, indices) of the related
+    artists of each artist, or None if they were not computed."""
+
+    def __init__(self, ids, relations, int_ids=False, closures=None):
+        self.ids = ids
+        self.relations = relations
+        self.int_ids = int_ids
+        self.closures = closures
+
+    def to_ids(self, positions):
+        """Returns the artist ids at positions of the ids array."""
+
+        ids = self.ids[positions].tolist()
+        return ids if self.int_ids else [str(i) for i in ids]
+
+    def find(self, artist_id):
+        """Returns the position of the artist in the ids array or -1."""
+        try:
+            key = int(artist_id)
+        except ValueError:
+            return -1
+        # Only the canonical strings, as the keys of the dict: "0123" or " 123"
+        # are not artist 123
+        if isinstance(artist_id, str) and str(key) != artist_id:
+            return -1
+        artist_id = key
+        if not 0 <= artist_id <= INT32_MAX:
+            return -1
+        # With the dtype of the array, otherwise the whole array is converted
+        i = int(self.ids.searchsorted(np.int32(artist_id)))
+        if i < len(self.ids) and self.ids[i] == artist_id:
+            return i
+        return -1
+
+    def related_artists(self, artist_id):
+        """Returns the ids collected by collect_all_related_artists for the
+        artist, from the closures, including artist_id itself."""
+
+        i = self.find(artist_id)
+        if i == -1:
+            return [artist_id]
+        offsets, indices = self.closures
+        return self.to_ids(indices[offsets[i] : offsets[i + 1]]) + [artist_id]
+
+    def __contains__(self, artist_id):
+        return self.find(artist_id) != -1
+
+    def __getitem__(self, artist_id):
+        i = self.find(artist_id)
+        if i == -1:
+            raise KeyError(artist_id)
+        return ArtistRelations(self, i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.to_ids(slice(None)))
+
+
+def artists_to_graph(artists):
+    """Returns the ArtistGraph of an iterable of artist dictionaries as in
+    artists.jsonl.clean."""
+
+    # Flat arrays instead of lists of ints, they take 8 bytes per entry
+    artist_ids = array("q")
+    sources = {relation: array("q") for relation in RELATIONS}
+    targets = {relation: array("q") for relation in RELATIONS}
+    for row, artist in enumerate(artists):
+        artist_ids.append(int(artist["id"]))
+        for relation in RELATIONS:
+            related = artist.get(relation, ())
+            sources[relation].extend(repeat(row, len(related)))
+            targets[relation].extend(map(int, related))
+
+    artist_ids = np.frombuffer(artist_ids, dtype=np.int64)
+    assert INT32_MAX >= artist_ids.max(initial=0), "Ids exceed int32"
+    ids = np.sort(artist_ids).astype(np.int32)
+    assert (np.diff(ids) > 0).all(), "Duplicate artist ids"
+    # Position of each row of the file in the ids array
+    row_positions = np.searchsorted(ids, artist_ids)
+
+    relations = {}
+    for relation in RELATIONS:
+        source = row_positions[np.frombuffer(sources[relation], dtype=np.int64)]
+        target = np.frombuffer(targets[relation], dtype=np.int64)
+        # Group the related artists by artist, keeping their order in the file
+        order = np.argsort(source, kind="stable")
+        indices = np.searchsorted(ids, target[order])
+        assert (
+            ids[np.minimum(indices, len(ids) - 1)] == target[order]
+        ).all(), f"Some {relation} are not in the artists file"
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=len(ids)), out=offsets[1:])
+        assert offsets[-1] <= INT32_MAX, "Too many relations for int32"
+        relations[relation] = (offsets.astype(np.int32), indices.astype(np.int32))
+    graph = ArtistGraph(ids, relations)
+    graph.closures = related_closures(graph)
+    return graph
+
+
+def follow_relation(graph, sources, targets, relation):
+    """Returns the (source, related) position pairs of the artists related by
+    relation to the targets of the (source, target) pairs."""
+
+    offsets, indices = graph.relations[relation]
+    starts = offsets[targets].astype(np.int64)
+    degrees = offsets[targets + 1] - starts
+    # Position of each related artist in the indices array
+    ends = np.cumsum(degrees)
+    steps = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - degrees, degrees)
+    return np.repeat(sources, degrees), indices[np.repeat(starts, degrees) + steps]
+
+
+def related_closures(graph):
+    """Returns the (offsets, indices) of the artists collected by
+    collect_all_related_artists for each artist, without the artist itself
+    unless it is related to itself, computed for all the artists at once."""
+
+    n_artists = len(graph.ids)
+    # The pairs are encoded as source * n_artists + related
+    keys = []
+    for path in CLOSURE_PATHS:
+        sources = targets = np.arange(n_artists, dtype=np.int64)
+        for relation in path:
+            sources, targets = follow_relation(graph, sources, targets, relation)
+            keys.append(sources * n_artists + targets)
+    sources, targets = np.divmod(np.unique(np.concatenate(keys)), n_artists)
+    offsets = np.zeros(n_artists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_artists), out=offsets[1:])
+    assert offsets[-1] <= INT32_MAX, "Too many related artists for int32"
+    return offsets.astype(np.int32), targets.astype(np.int32)
+
+
+def build_artist_graph(artists_json):
+    """Reads the artists file and returns its ArtistGraph in memory."""
+
+    with open_jsonl(artists_json) as infile:
+        return artists_to_graph(loads(jsonline) for jsonline in infile)
+
+
+def file_signature(path):
+    """Returns the size, the modification time and a hash of the first and the
+    last SIGNATURE_BYTES of the file, which identify a version of the file
+    without reading all of it."""
+
+    stat = os.stat(path)
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        digest.update(f.read(SIGNATURE_BYTES))
+        if stat.st_size > SIGNATURE_BYTES:
+            f.seek(max(SIGNATURE_BYTES, stat.st_size - SIGNATURE_BYTES))
+            digest.update(f.read())
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": digest.hexdigest(),
+    }
+
+
+def save_artist_graph(graph, graph_dir, artists_json=None):
+    """Saves the arrays of the graph as .npy files in graph_dir. If the graph
+    was built from artists_json, the signature of the file is saved with the
+    arrays, see load_valid_artist_graph."""
+
+    os.makedirs(graph_dir, exist_ok=True)
+    # Remove the old signature first, the graph is invalid until it is written
+    source_path = os.path.join(graph_dir, "source.json")
+    if os.path.isfile(source_path):
+        os.remove(source_path)
+    np.save(os.path.join(graph_dir, "ids.npy"), graph.ids)
+    for relation, (offsets, indices) in graph.relations.items():
+        np.save(os.path.join(graph_dir, f"{relation}_offsets.npy"), offsets)
+        np.save(os.path.join(graph_dir, f"{relation}_indices.npy"), indices)
+    for name, array in zip(("offsets", "indices"), graph.closures or (None, None)):
+        path = os.path.join(graph_dir, f"closures_{name}.npy")
+        if array is not None:
+            np.save(path, array)
+        elif os.path.isfile(path):
+            os.remove(path)
+    if artists_json is not None:
+        with open(source_path, "w") as f:
+            json.dump(file_signature(artists_json), f)
+
+
+def load_artist_graph(graph_dir, mmap=True, int_ids=False):
+    """Loads a graph saved with save_artist_graph, memory-mapped by default.
+    With int_ids the artist ids are given as ints instead of strings."""
+
+    def load(name):
+        array = np.load(os.path.join(graph_dir, name), mmap_mode="r" if mmap else None)
+        # Plain arrays on the same memory, indexing a np.memmap is much slower
+        return array.view(np.ndarray)
+
+    ids = load("ids.npy")
+    relations = {}
+    for relation in RELATIONS:
+        relations[relation] = (
+            load(f"{relation}_offsets.npy"),
+            load(f"{relation}_indices.npy"),
+        )
+    # Graphs saved before the closures were added have none
+    closures = None
+    if os.path.isfile(os.path.join(graph_dir, "closures_offsets.npy")):
+        closures = (load("closures_offsets.npy"), load("closures_indices.npy"))
+    return ArtistGraph(ids, relations, int_ids, closures)
+
+
+def load_valid_artist_graph(artists_json, int_ids=False):
+    """Loads the graph saved next to artists_json by clean_artists.py or
+    save_artist_graph. Returns None if there is no graph or if it was built
+    from a different version of the file, i.e. the size, modification time or
+    hash of the file changed."""
+
+    graph_dir = get_graph_dir(artists_json)
+    try:
+        with open(os.path.join(graph_dir, "source.json")) as f:
+            signature = json.load(f)
+        if signature != file_signature(artists_json):
+            return None
+        return load_artist_graph(graph_dir, int_ids=int_ids)
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("artists_json", type=str, help="Parsed artists.json.clean file.")
+    parser.add_argument(
+        "--graph-dir",
+        "-o",
+        type=str,
+        default=None,
+        help="Output directory of the graph. Defaults to artists_json + .graph",
+    )
+    args = parser.parse_args()
+
+    graph_dir = args.graph_dir or get_graph_dir(args.artists_json)
+    t0 = time.monotonic()
+    print(f"Building the artist graph of {args.artists_json}")
+    graph = build_artist_graph(args.artists_json)
+    save_artist_graph(graph, graph_dir, args.artists_json)
+    print(f"{len(graph):>10,} artists saved to {graph_dir}")
+    for relation, (_, indices) in graph.relations.items():
+        print(f"{len(indices):>10,} {relation}")
+    print(f"{len(graph.closures[1]):>10,} related artists")
+    print(
+        "Processing time: "
+        f"{time.strftime('%H:%M:%S', time.gmtime(time.monotonic()-t0))}"
+    )
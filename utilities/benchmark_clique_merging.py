@@ -0,0 +1,162 @@
+"""Compares the merging of groups with intersecting writers of clique_finder.py,
+which finds the groups to merge through an inverted index from writer to
+groups, with its previous implementation, which rescans all the pairs of groups
+after every merge. Checks on random titles that both give the same groups, with
+their writers and their tracks or versions in the same order, for the versions
+of read_tracks and for the cliques of group_versions, and reports the time of
+each, the best of --repeats runs without garbage collection. Up to SMALL_GROUPS
+groups both compare all the pairs. The previous implementation is quadratic to
+cubic in the number of writer groups of a title, so the time grows fast with
+--max-groups."""
+
+import gc
+import os
+import sys
+import time
+import random
+import argparse
+from copy import deepcopy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discogs_vi"
+    )
+)
+from clique_finder import merge_intersecting_writers, group_versions
+
+
+def reference_merge_intersecting_writers(writers_and_tracks):
+    merged = True
+    while merged:
+        merged = False
+        for i, (writers, _) in enumerate(writers_and_tracks):
+            for j, (writers2, tracks2) in enumerate(writers_and_tracks[i + 1 :]):
+                if writers & writers2:
+                    writers_and_tracks[i][0] = writers.union(writers2)
+                    writers_and_tracks[i][1].extend(tracks2)
+                    del writers_and_tracks[i + j + 1]
+                    merged = True
+                    break
+            if merged:
+                break
+
+
+def reference_group_versions(versions):
+    cliques = []
+    for version_writers, version_tracks in versions:
+        found = False
+        for i, (clique_writers, _) in enumerate(cliques):
+            if clique_writers & version_writers:
+                cliques[i][0] = clique_writers.union(version_writers)
+                cliques[i][1].append(version_tracks)
+                found = True
+                break
+        if not found:
+            cliques.append([version_writers, [version_tracks]])
+    reference_merge_intersecting_writers(cliques)
+    return cliques
+
+
+def random_groups(n_groups, n_writers, rng):
+    """Returns n_groups [writers, tracks] groups of a title. The writers are
+    drawn from n_writers with a skewed distribution, as a few writers are
+    credited on most of the versions of a popular title."""
+
+    groups = []
+    for i in range(n_groups):
+        size = rng.choice([0, 1, 1, 1, 2, 2, 3, 5])
+        writers = frozenset(
+            int(rng.paretovariate(1.2)) % n_writers for _ in range(size)
+        )
+        groups.append([writers, [f"T-{i}-{k}" for k in range(rng.randint(1, 3))]])
+    return groups
+
+
+def chained_groups(n_groups):
+    """Returns n_groups groups of a title, half with their own writer and half
+    where each group shares a writer with the previous one only, in reverse
+    order. The previous implementation rescans all the pairs of groups before
+    the chain after every merge."""
+
+    n_single = n_groups // 2
+    groups = [[frozenset({-i - 1}), [f"S-{i}"]] for i in range(n_single)]
+    for i in reversed(range(n_groups - n_single)):
+        groups.append([frozenset({i, i + 1}), [f"T-{i}"]])
+    return groups
+
+
+def timed(function, titles, repeats):
+    """Returns the best time of running function on a copy of each title,
+    without garbage collection, and the results of the last run."""
+
+    best = float("inf")
+    for _ in range(repeats):
+        copies = deepcopy(titles)
+        gc.collect()
+        gc.disable()
+        t0 = time.perf_counter()
+        results = list(map(function, copies))
+        best = min(best, time.perf_counter() - t0)
+        gc.enable()
+    return best, results, copies
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--n-titles", "-n", type=int, default=2000, help="Number of random titles."
+    )
+    parser.add_argument(
+        "--max-groups",
+        "-m",
+        type=int,
+        default=300,
+        help="Maximum number of writer groups of a title.",
+    )
+    parser.add_argument(
+        "--repeats", "-r", type=int, default=3, help="Runs of each implementation."
+    )
+    parser.add_argument("--seed", "-s", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    titles = []
+    for _ in range(args.n_titles):
+        n_groups = rng.randint(1, args.max_groups)
+        titles.append(random_groups(n_groups, rng.randint(1, 2 * n_groups), rng))
+    titles.append(chained_groups(args.max_groups))
+
+    failed = False
+    print(
+        f"{'merge':>10} {'before (s)':>11} {'after (s)':>10} {'speedup':>8} "
+        f"{'identical':>10}"
+    )
+
+    # The versions of each performer set in read_tracks, merged in place
+    t_reference, _, expected = timed(
+        reference_merge_intersecting_writers, titles, args.repeats
+    )
+    t_function, _, outputs = timed(merge_intersecting_writers, titles, args.repeats)
+    identical = outputs == expected
+    failed |= not identical
+    print(
+        f"{'versions':>10} {t_reference:>11.3f} {t_function:>10.3f} "
+        f"{t_reference / t_function:>8.2f} {str(identical):>10}"
+    )
+
+    # The cliques of each title in find_cliques, with the versions as they
+    # are after read_tracks, one per performer set
+    t_reference, expected, _ = timed(reference_group_versions, titles, args.repeats)
+    t_function, outputs, _ = timed(group_versions, titles, args.repeats)
+    identical = outputs == expected
+    failed |= not identical
+    print(
+        f"{'cliques':>10} {t_reference:>11.3f} {t_function:>10.3f} "
+        f"{t_reference / t_function:>8.2f} {str(identical):>10}"
+    )
+    if failed:
+        sys.exit("The outputs are different.")
@@ -0,0 +1,72 @@
+"""Compares the JSON codec backends on real release and track lines. For each
+backend it reports the time to decode the lines and to encode them back, and
+checks that the results are identical to the json module."""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import available_backends, get_codec
+
+
+def read_lines(jsonl_file, n_lines):
+    lines = []
+    with open_jsonl(jsonl_file) as in_f:
+        for jsonline in in_f:
+            lines.append(jsonline)
+            if len(lines) == n_lines:
+                break
+    return lines
+
+
+def benchmark(lines, loads, dumps, repeats):
+    """Returns the best decoding and encoding times over repeats and the
+    decoded objects and encoded lines of the last repeat."""
+
+    t_loads, t_dumps = float("inf"), float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        objs = [loads(line) for line in lines]
+        t1 = time.perf_counter()
+        encoded = [dumps(obj) + "\n" for obj in objs]
+        t2 = time.perf_counter()
+        t_loads, t_dumps = min(t_loads, t1 - t0), min(t_dumps, t2 - t1)
+    return t_loads, t_dumps, objs, encoded
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "jsonl_files",
+        type=str,
+        nargs="+",
+        help="Line-delimited JSON files, e.g. the .clean releases and the .tracks files.",
+    )
+    parser.add_argument(
+        "--n-lines", "-n", type=int, default=100000, help="Lines to read per file."
+    )
+    parser.add_argument(
+        "--repeats", "-r", type=int, default=3, help="Repeats per measurement."
+    )
+    args = parser.parse_args()
+
+    for jsonl_file in args.jsonl_files:
+        lines = read_lines(jsonl_file, args.n_lines)
+        reference = [json.loads(line) for line in lines]
+        print(f"{jsonl_file}: {len(lines):,} lines")
+        print(f"{'backend':>10} {'loads (s)':>10} {'dumps (s)':>10} {'identical':>10}")
+        for backend in available_backends():
+            loads, dumps = get_codec(backend)
+            t_loads, t_dumps, objs, encoded = benchmark(
+                lines, loads, dumps, args.repeats
+            )
+            identical = objs == reference and encoded == lines
+            print(f"{backend:>10} {t_loads:>10.3f} {t_dumps:>10.3f} {str(identical):>10}")
+        print()
@@ -0,0 +1,117 @@
+"""Compares the time of clique_finder.read_tracks when the related artists of
+each artist are collected for every track, when they are collected once and
+cached with RelatedArtistsIndex, and when they are read from the closures of the
+artist graph, from the artists dictionary or from the graph. Checks that all
+give the same tracks. The time of the artist collection alone, without reading
+the tracks, is also reported. The speedup grows with the number of related
+artists of the frequent artists."""
+
+import gc
+import io
+import os
+import sys
+import time
+import argparse
+from contextlib import redirect_stdout
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discogs_vi")
+)
+from clique_finder import read_tracks, load_artists_dict
+from utilities.utils import (
+    RelatedArtistsIndex,
+    collect_performance_artists,
+    collect_writer_artists,
+)
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+from utilities.artist_graph import build_artist_graph, related_closures, ArtistGraph
+
+
+def timed_read_tracks(tracks_json, artists_dict, cache):
+    """Returns the time of read_tracks and its result, without its prints."""
+
+    gc.collect()
+    t0 = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        tracks_dict = read_tracks(tracks_json, artists_dict, cache=cache)
+    return time.perf_counter() - t0, tracks_dict
+
+
+def timed_collect(tracks, artists_dict):
+    """Returns the time of collecting the artists of the tracks as read_tracks
+    does."""
+
+    gc.collect()
+    t0 = time.perf_counter()
+    for track in tracks:
+        frozenset(collect_performance_artists(track, artists_dict))
+        frozenset(collect_writer_artists(track, artists_dict))
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("tracks_json", type=str, help="Parsed .tracks file.")
+    parser.add_argument("artists_json", type=str, help="Parsed artists.json.clean file.")
+    parser.add_argument(
+        "--repeats", "-r", type=int, default=3, help="Repeats per measurement."
+    )
+    args = parser.parse_args()
+
+    print("Loading the artists dictionary and building the artist graph...")
+    artists_dict = load_artists_dict(args.artists_json)
+    graph = build_artist_graph(args.artists_json)
+    t0 = time.perf_counter()
+    related_closures(graph)
+    t_closures = time.perf_counter() - t0
+    walked_graph = ArtistGraph(graph.ids, graph.relations)
+
+    # The artists of each mode and whether they are cached
+    modes = {
+        "no cache": (artists_dict, False),
+        "cache": (artists_dict, True),
+        "graph": (walked_graph, True),
+        "closures": (graph, True),
+    }
+    # Alternate the modes so that all are affected alike by the machine load
+    times = dict.fromkeys(modes, float("inf"))
+    identical = {}
+    for _ in range(args.repeats):
+        for mode, (artists, cache) in modes.items():
+            t, tracks_dict = timed_read_tracks(args.tracks_json, artists, cache)
+            times[mode] = min(times[mode], t)
+            if mode == "no cache":
+                reference = tracks_dict
+            identical[mode] = tracks_dict == reference
+
+    print(f"{'mode':>12} {'time (s)':>10} {'speedup':>8} {'identical':>10}")
+    for mode in modes:
+        print(
+            f"{mode:>12} {times[mode]:>10.3f} {times['no cache'] / times[mode]:>8.2f} "
+            f"{str(identical[mode]):>10}"
+        )
+
+    with open_jsonl(args.tracks_json) as infile:
+        tracks = [loads(jsonline) for jsonline in infile]
+    t_plain, t_cold, t_warm, t_closures_cold = (float("inf"),) * 4
+    for _ in range(args.repeats):
+        t_plain = min(t_plain, timed_collect(tracks, artists_dict))
+        warm_index = RelatedArtistsIndex(artists_dict)
+        t_cold = min(t_cold, timed_collect(tracks, warm_index))
+        t_warm = min(t_warm, timed_collect(tracks, warm_index))
+        closures_index = RelatedArtistsIndex(graph)
+        t_closures_cold = min(t_closures_cold, timed_collect(tracks, closures_index))
+    print(f"Collecting the artists of {len(tracks):,} tracks:")
+    print(f"{'no cache':>12} {t_plain:>10.3f}s")
+    print(f"{'cold cache':>12} {t_cold:>10.3f}s {t_plain / t_cold:>8.2f}x")
+    print(f"{'warm cache':>12} {t_warm:>10.3f}s {t_plain / t_warm:>8.2f}x")
+    print(
+        f"{'closures':>12} {t_closures_cold:>10.3f}s "
+        f"{t_plain / t_closures_cold:>8.2f}x"
+    )
+    print(f"Computing the closures of {len(graph):,} artists took {t_closures:.3f}s")
@@ -0,0 +1,163 @@
+"""Compares the table-driven remove_latin_diacritics, hard_clean_text and
+soft_clean_text of utilities/utils.py with their previous implementations,
+which process the text character by character. Checks that both give the same
+output for every title and artist name of the given line-delimited JSON files
+(releases, tracks or cliques) and for every single Unicode character, and
+reports the time of each. The functions are timed without the caches of
+memoize_text."""
+
+import os
+import re
+import sys
+import time
+import argparse
+import unicodedata
+
+import unidecode
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.jsonl_io import open_jsonl
+from utilities.json_codec import loads
+from utilities.utils import (
+    is_latin_character,
+    remove_latin_diacritics,
+    hard_clean_text,
+    soft_clean_text,
+)
+
+# Keys of the strings to clean, in releases, tracks and cliques
+TEXT_KEYS = {"title", "name", "track_title", "release_title"}
+TEXT_LIST_KEYS = {
+    "track_writer_names",
+    "track_artist_names",
+    "track_feat_names",
+    "release_artist_names",
+    "release_writer_names",
+    "release_feat_names",
+}
+
+
+def reference_remove_latin_diacritics(text):
+    result = []
+    for char in text:
+        if unicodedata.category(char).startswith("L") and is_latin_character(char):
+            char = unidecode.unidecode(char)
+        result.append(char)
+    return "".join(result)
+
+
+def reference_hard_clean_text(text):
+    text = text.lower()
+    text = re.sub(r"\A(the|a|an)\s", "", text)
+    text = re.sub(r"\s&\s", " and ", text)
+    text = re.sub(r"[^\w\s]", "", text)
+    text = re.sub(r"\s{2,}", " ", text)
+    text = re.sub(r"\s\Z", "", text)
+    text = re.sub(r"\A\s", "", text)
+    return reference_remove_latin_diacritics(text)
+
+
+def reference_soft_clean_text(text):
+    text = text.lower()
+    text = re.sub(r"\A(the|a|an)\s", "", text)
+    text = re.sub(r"\s&\s", " and ", text)
+    result = []
+    for char in text:
+        category = unicodedata.category(char)
+        if category.startswith("L"):
+            if is_latin_character(char):
+                result.append(unidecode.unidecode(char))
+            else:
+                result.append(char)
+        elif category.startswith("P"):
+            char = re.sub(r"[―－‐‑‒–—﹘﹘﹣⁃]", "-", char)
+            char = re.sub(r'["‘’“”‚„‛‟]', "'", char)
+            result.append(char)
+        else:
+            result.append(char)
+    return "".join(result)
+
+
+FUNCTIONS = [
+    (
+        "remove_latin_diacritics",
+        remove_latin_diacritics,
+        reference_remove_latin_diacritics,
+    ),
+    ("hard_clean_text", hard_clean_text.__wrapped__, reference_hard_clean_text),
+    ("soft_clean_text", soft_clean_text.__wrapped__, reference_soft_clean_text),
+]
+
+
+def collect_texts(obj, texts):
+    """Adds the titles and the names in obj, a decoded line, to texts."""
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in TEXT_KEYS and isinstance(value, str):
+                texts.append(value)
+            elif key in TEXT_LIST_KEYS:
+                texts.extend(value)
+            else:
+                collect_texts(value, texts)
+    elif isinstance(obj, list):
+        for value in obj:
+            collect_texts(value, texts)
+
+
+def timed_map(function, texts):
+    t0 = time.perf_counter()
+    outputs = list(map(function, texts))
+    return time.perf_counter() - t0, outputs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "jsonl_files",
+        type=str,
+        nargs="+",
+        help="Line-delimited JSON files, e.g. the .clean releases and the .tracks files.",
+    )
+    parser.add_argument(
+        "--n-lines", "-n", type=int, default=100000, help="Lines to read per file."
+    )
+    args = parser.parse_args()
+
+    texts = []
+    for jsonl_file in args.jsonl_files:
+        with open_jsonl(jsonl_file) as in_f:
+            for i, jsonline in enumerate(in_f):
+                if i == args.n_lines:
+                    break
+                collect_texts(loads(jsonline), texts)
+    n_ascii = sum(map(str.isascii, texts))
+    print(f"{len(texts):,} titles and names, {n_ascii:,} of them ASCII")
+
+    # Every character on its own, except the surrogates
+    characters = [
+        chr(c) for c in range(0x110000) if unicodedata.category(chr(c)) != "Cs"
+    ]
+
+    failed = False
+    print(
+        f"{'function':>24} {'before (s)':>11} {'after (s)':>10} {'speedup':>8} "
+        f"{'identical':>10}"
+    )
+    for name, function, reference in FUNCTIONS:
+        t_reference, expected = timed_map(reference, texts)
+        t_function, outputs = timed_map(function, texts)
+        identical = outputs == expected
+        identical &= list(map(function, characters)) == list(
+            map(reference, characters)
+        )
+        failed |= not identical
+        print(
+            f"{name:>24} {t_reference:>11.3f} {t_function:>10.3f} "
+            f"{t_reference / t_function:>8.2f} {str(identical):>10}"
+        )
+    if failed:
+        sys.exit("The outputs are different.")
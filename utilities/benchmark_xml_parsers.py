@@ -0,0 +1,220 @@
+"""Checks that preprocess_releases_xml.py and preprocess_artists_xml.py write
+the same JSON lines with --parser expat as with the default xmltodict parser,
+with a single process and with --workers, and reports the time of each run.
+Runs on the given releases and artists dumps, or on small synthetic dumps with
+the features that the parsers handle differently: attributes, empty and
+skipped elements, character references and text split across lines. Exits
+with an error if any output is different."""
+
+import os
+import sys
+import time
+import random
+import filecmp
+import argparse
+import tempfile
+import subprocess
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discogs_vi"
+    )
+)
+from xml_utils import PARSERS, get_output_name
+
+SCRIPTS = {
+    "releases": os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "discogs_vi",
+        "preprocess_releases_xml.py",
+    ),
+    "artists": os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "discogs_vi",
+        "preprocess_artists_xml.py",
+    ),
+}
+
+WORDS = ["Summertime", "the", "Café", "&", "<Live>", "日本", "“Hi”", "Þór", "(2)"]
+ROLES = ["Written-By", "Featuring", "Vocals [Featuring]", "Producer", ""]
+
+
+def random_text(rng):
+    return escape(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))))
+
+
+def random_artist(rng, role):
+    return (
+        f"<artist><id>{rng.randint(1, 200)}</id><name>{random_text(rng)}</name>"
+        f"<anv></anv><join>{rng.choice(['', ','])}</join>"
+        f"<role>{escape(role)}</role><tracks></tracks></artist>"
+    )
+
+
+def write_releases(path, n_releases, rng):
+    """Writes a synthetic releases dump."""
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<releases>')
+        for i in range(1, n_releases + 1):
+            f.write(f'<release id="{i}" status="Accepted">')
+            if rng.random() < 0.5:
+                f.write('<images><image type="primary" uri="" width="600"/></images>')
+            f.write("<artists>" + random_artist(rng, "") + "</artists>")
+            f.write(f"<title>{random_text(rng)}</title>")
+            f.write(
+                "<labels>"
+                + "".join(
+                    f"<label name={quoteattr(name)} catno=\"X1\"/>"
+                    for name in rng.sample(["Ça & Co", "EMI", "Svek", "Blue Note"], 2)
+                )
+                + "</labels>"
+            )
+            if rng.random() < 0.2:
+                f.write("<extraartists/>")
+            else:
+                f.write(
+                    "<extraartists>"
+                    + random_artist(rng, rng.choice(ROLES))
+                    + "</extraartists>"
+                )
+            f.write("<genres><genre>Rock</genre><genre>Pop</genre></genres>")
+            if rng.random() < 0.5:
+                f.write("<notes>Some &lt;notes&gt;\n on two lines</notes>")
+            f.write("<data_quality>Needs Vote</data_quality>")
+            if rng.random() < 0.7:
+                f.write(f'<master_id is_main_release="true">{i % 50}</master_id>')
+            f.write("<tracklist>")
+            for _ in range(rng.randint(1, 4)):
+                f.write(
+                    f"<track><position>A1</position><title>{random_text(rng)}</title>"
+                )
+                if rng.random() < 0.7:
+                    f.write(
+                        "<extraartists>"
+                        + random_artist(rng, rng.choice(ROLES))
+                        + "</extraartists>"
+                    )
+                f.write("</track>")
+            f.write("</tracklist>")
+            if rng.random() < 0.5:
+                f.write(
+                    '<videos><video src="https://www.youtube.com/watch?v=x" '
+                    f'duration="60" embed="true"><title>{random_text(rng)}</title>'
+                    "<description>d</description></video></videos>"
+                )
+            f.write("</release>\n" if rng.random() < 0.5 else "</release>")
+        f.write("</releases>\n")
+
+
+def write_artists(path, n_artists, rng):
+    """Writes a synthetic artists dump."""
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<artists>')
+        for i in range(1, n_artists + 1):
+            f.write("<artist>")
+            if rng.random() < 0.5:
+                f.write('<images><image type="primary" uri="" width="600"/></images>')
+            f.write(f"<id>{i}</id><name>{random_text(rng)}</name>")
+            f.write(f"<profile>{rng.choice(['', 'A profile'])}</profile>")
+            if rng.random() < 0.4:
+                f.write(
+                    "<namevariations>"
+                    + "".join(f"<name>{random_text(rng)}</name>" for _ in range(2))
+                    + "</namevariations>"
+                )
+            if rng.random() < 0.3:
+                j = rng.randint(1, n_artists)
+                f.write(f'<aliases><name id="{j}">{random_text(rng)}</name></aliases>')
+            if rng.random() < 0.15:
+                ids = rng.sample(range(1, n_artists + 1), 3)
+                f.write(
+                    "<members>"
+                    + "".join(f"<id>{j}</id>" for j in ids)
+                    + "".join(f'<name id="{j}">{random_text(rng)}</name>' for j in ids)
+                    + "</members>"
+                )
+            f.write("</artist>\n")
+        f.write("</artists>\n")
+
+
+def run(kind, xml_file, output_dir, parser, workers):
+    """Runs the preprocessing script of kind and returns its time and output
+    path."""
+
+    os.makedirs(output_dir)
+    command = [sys.executable, SCRIPTS[kind], xml_file, "-o", output_dir]
+    command += ["--parser", parser, "--workers", str(workers)]
+    # The labels of a release are kept in a set, fix their order
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    t0 = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=env)
+    return time.perf_counter() - t0, os.path.join(
+        output_dir, get_output_name(xml_file)
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--releases-xml", "-r", type=str, default=None, help="Releases dump."
+    )
+    parser.add_argument(
+        "--artists-xml", "-a", type=str, default=None, help="Artists dump."
+    )
+    parser.add_argument(
+        "--n-items",
+        "-n",
+        type=int,
+        default=5000,
+        help="Releases and artists of the synthetic dumps, if no dump is given.",
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=3, help="Workers of the parallel runs."
+    )
+    parser.add_argument("--seed", "-s", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rng = random.Random(args.seed)
+        xml_files = {"releases": args.releases_xml, "artists": args.artists_xml}
+        if xml_files["releases"] is None and xml_files["artists"] is None:
+            xml_files["releases"] = os.path.join(tmp_dir, "releases.xml")
+            xml_files["artists"] = os.path.join(tmp_dir, "artists.xml")
+            write_releases(xml_files["releases"], args.n_items, rng)
+            write_artists(xml_files["artists"], args.n_items, rng)
+
+        print(
+            f"{'dump':>10} {'parser':>10} {'workers':>8} {'time (s)':>9} "
+            f"{'identical':>10}"
+        )
+        for kind, xml_file in xml_files.items():
+            if xml_file is None:
+                continue
+            reference = None
+            for workers in sorted({1, args.workers}):
+                for xml_parser in PARSERS:
+                    output_dir = os.path.join(
+                        tmp_dir, f"{kind}-{xml_parser}-{workers}"
+                    )
+                    t, output_path = run(
+                        kind, xml_file, output_dir, xml_parser, workers
+                    )
+                    # The first run, xmltodict with a single process, is the reference
+                    if reference is None:
+                        reference = output_path
+                    identical = filecmp.cmp(reference, output_path, shallow=False)
+                    failed |= not identical
+                    print(
+                        f"{kind:>10} {xml_parser:>10} {workers:>8} {t:>9.2f} "
+                        f"{str(identical):>10}"
+                    )
+    if failed:
+        sys.exit("The outputs are different.")
@@ -0,0 +1,93 @@
+"""Checks that the parallel stages give the same output when their workers
+receive the artist ids through pickle, as with the spawn and forkserver start
+methods, the defaults on macOS and, from Python 3.14, on Linux. The ArtistIds
+sets are pickled and loaded back with string and int ids, and then
+clean_releases.py and parse_releases_to_tracks.py are run on the given files with
+--int-ids, with a single process and with --workers under the spawn start
+method. Exits with an error if any result is different."""
+
+import io
+import os
+import sys
+import pickle
+import filecmp
+import argparse
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discogs_vi"
+    )
+)
+import clean_releases
+import parse_releases_to_tracks
+from clean_releases import ArtistIds
+
+
+def check_pickle(ids, int_ids):
+    """Returns True if the ArtistIds of ids are the same after pickling."""
+
+    artist_ids = ArtistIds(ids, int_ids)
+    loaded = pickle.loads(pickle.dumps(artist_ids))
+    return (
+        type(loaded) is ArtistIds
+        and loaded == artist_ids
+        and loaded.key is artist_ids.key
+        and loaded.excluded == artist_ids.excluded
+        and all(artist_ids.key(_id) in loaded for _id in ids)
+    )
+
+
+def run(stage, input_json, artists_json, output_json, workers):
+    """Runs the main function of the stage with int ids, without its prints."""
+
+    with redirect_stdout(io.StringIO()):
+        stage.main(
+            input_json, artists_json, output_json, int_ids=True, workers=workers
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("releases_json", type=str, help="Parsed releases file.")
+    parser.add_argument(
+        "artists_json", type=str, help="Parsed artists.json.clean file."
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=2, help="Workers of the parallel runs."
+    )
+    args = parser.parse_args()
+
+    # The labels of a release are kept in a set, fix their order in this
+    # process and in the workers
+    if os.environ.get("PYTHONHASHSEED") != "0":
+        env = dict(os.environ, PYTHONHASHSEED="0")
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    failed = False
+    for int_ids in (False, True):
+        identical = check_pickle(["1", "123", "194"], int_ids)
+        failed |= not identical
+        print(f"{'ArtistIds':>24} {'int' if int_ids else 'str':>4} {identical}")
+
+    multiprocessing.set_start_method("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_json = args.releases_json
+        for stage in (clean_releases, parse_releases_to_tracks):
+            outputs = []
+            for workers in (1, args.workers):
+                outputs.append(os.path.join(tmp_dir, f"{stage.__name__}-{workers}"))
+                run(stage, input_json, args.artists_json, outputs[-1], workers)
+            identical = filecmp.cmp(*outputs, shallow=False)
+            failed |= not identical
+            print(f"{stage.__name__:>24} {'int':>4} {identical}")
+            # The tracks are parsed from the clean releases
+            input_json = outputs[0]
+    if failed:
+        sys.exit("The results are different.")
@@ -0,0 +1,84 @@
+"""JSON codec used by the pipeline stages in their line-by-line loops.
+
+Decoding uses the fastest available backend: orjson, msgspec or the standard
+library json module. It can be forced with the DISCOGS_VI_JSON environment
+variable, e.g. DISCOGS_VI_JSON=json. If a fast backend rejects a line that the
+json module accepts (e.g. NaN or very large integers) the line is decoded with
+the json module, so the decoded objects are always the same.
+
+Encoding always produces the same bytes as json.dumps(obj, ensure_ascii=False)
+with the key order of the dict. orjson and msgspec only write compact JSON,
+without the spaces after "," and ":", so the encoding is done by the C encoder
+of the json module, re-using a single encoder instance. Sets are encoded as
+lists and the records of utilities.records as their dicts."""
+
+import os
+import sys
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.records import Record
+
+BACKENDS = ["orjson", "msgspec", "json"]
+
+
+def available_backends():
+    """Returns the backends that are installed, fastest first."""
+
+    installed = {"orjson": orjson, "msgspec": msgspec, "json": json}
+    return [backend for backend in BACKENDS if installed[backend] is not None]
+
+
+def _default(obj):
+    """Convert sets to lists and records to dicts for json encoding"""
+
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def get_codec(backend):
+    """Returns the (loads, dumps) functions of a backend."""
+
+    assert backend in available_backends(), f"{backend} is not installed"
+
+    if backend == "orjson":
+
+        def loads(s):
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                return json.loads(s)
+
+    elif backend == "msgspec":
+        decoder = msgspec.json.Decoder()
+
+        def loads(s):
+            try:
+                return decoder.decode(s)
+            except msgspec.DecodeError:
+                return json.loads(s)
+
+    else:
+        loads = json.loads
+
+    # Same output as json.dumps(obj, ensure_ascii=False)
+    dumps = json.JSONEncoder(ensure_ascii=False, default=_default).encode
+
+    return loads, dumps
+
+
+BACKEND = os.environ.get("DISCOGS_VI_JSON", available_backends()[0])
+loads, dumps = get_codec(BACKEND)
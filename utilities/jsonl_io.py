@@ -0,0 +1,280 @@
+"""Reading and writing the line-delimited JSON files of the pipeline. Paths
+ending with .zst are zstd compressed, everything else is plain UTF-8 text.
+
+The compressed files are written as a sequence of independent zstd frames that
+always end on a line boundary, followed by a seek table in the zstd seekable
+format. They can be decompressed with the zstd command line tool as usual,
+and thanks to the seek table they can be split into shards that are read in
+parallel, or read starting from any frame, i.e. resumed mid-file."""
+
+import io
+import os
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Uncompressed size of each zstd frame
+FRAME_SIZE = 2**20
+COMPRESSION_LEVEL = 3
+
+# Size of the blocks read from plain text files when searching for line starts
+READ_SIZE = 2**16
+
+# zstd seekable format constants
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+FOOTER_SIZE = 9
+
+
+def is_compressed(path):
+    return path.endswith(".zst")
+
+
+def add_suffix(path, suffix):
+    """Adds a suffix to the path while keeping the compression extension.
+    E.g. releases.jsonl.zst + .clean -> releases.jsonl.clean.zst"""
+
+    if is_compressed(path):
+        return path[: -len(".zst")] + suffix + ".zst"
+    return path + suffix
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise ImportError("zstandard is required for .zst files: pip install zstandard")
+
+
+def read_seek_table(f):
+    """Reads the seek table at the end of a compressed file. Returns a list of
+    (compressed_offset, compressed_size, decompressed_size) tuples, one for each
+    frame, or None if the file has no seek table."""
+
+    file_size = f.seek(0, os.SEEK_END)
+    if file_size < FOOTER_SIZE + 8:
+        return None
+    f.seek(file_size - FOOTER_SIZE)
+    n_frames, descriptor, magic = struct.unpack("<IBI", f.read(FOOTER_SIZE))
+    if magic != SEEKABLE_MAGIC:
+        return None
+    entry_size = 12 if descriptor & 0x80 else 8
+    table_size = n_frames * entry_size + FOOTER_SIZE
+    f.seek(file_size - table_size - 8)
+    skippable_magic, frame_size = struct.unpack("<II", f.read(8))
+    assert skippable_magic == SKIPPABLE_MAGIC and frame_size == table_size
+    entries = f.read(n_frames * entry_size)
+
+    frames, offset = [], 0
+    for i in range(n_frames):
+        c_size, d_size = struct.unpack_from("<II", entries, i * entry_size)
+        frames.append((offset, c_size, d_size))
+        offset += c_size
+    return frames
+
+
+def _write_seek_table(f, frames):
+    entries = b"".join(struct.pack("<II", c, d) for _, c, d in frames)
+    table_size = len(entries) + FOOTER_SIZE
+    f.write(struct.pack("<II", SKIPPABLE_MAGIC, table_size))
+    f.write(entries)
+    f.write(struct.pack("<IBI", len(frames), 0, SEEKABLE_MAGIC))
+
+
+class _ZstdWriter:
+    """Writes text lines to a compressed file, in frames of about FRAME_SIZE
+    bytes. The seek table is written when the file is closed."""
+
+    def __init__(self, path, mode="w", frame_size=FRAME_SIZE, level=COMPRESSION_LEVEL):
+        _check_zstandard()
+        self.frame_size = frame_size
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.buffer, self.buffered = [], 0
+        self.frames = []
+        if mode == "a" and os.path.isfile(path) and os.path.getsize(path) > 0:
+            # Continue after the last frame, the seek table is re-written on close
+            self.f = open(path, "r+b")
+            self.frames = read_seek_table(self.f)
+            assert self.frames is not None, f"{path} has no seek table to append to"
+            self.f.truncate(self.tell())
+            self.f.seek(self.tell())
+        else:
+            self.f = open(path, "wb")
+
+    def tell(self):
+        """Returns the compressed offset where the next frame will start."""
+        if not self.frames:
+            return 0
+        offset, c_size, _ = self.frames[-1]
+        return offset + c_size
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.buffer.append(data)
+        self.buffered += len(data)
+        # Frames end only at line boundaries
+        if self.buffered >= self.frame_size and data.endswith(b"\n"):
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        """Compresses the buffered lines into a frame."""
+        if not self.buffered:
+            return
+        data = b"".join(self.buffer)
+        frame = self.compressor.compress(data)
+        self.frames.append((self.tell(), len(frame), len(data)))
+        self.f.write(frame)
+        self.buffer, self.buffered = [], 0
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        _write_seek_table(self.f, self.frames)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ZstdReader:
+    """Iterates over the text lines of a compressed file, starting at the
+    compressed offset start (a frame boundary) and stopping at end. Like a
+    file, it is its own iterator, so it can be read in several loops."""
+
+    def __init__(self, path, start=0, end=None):
+        _check_zstandard()
+        self.f = open(path, "rb")
+        self.frames = read_seek_table(self.f)
+        self.start, self.end = start, end
+        self.lines = self._read_lines()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def _read_lines(self):
+        decompressor = zstandard.ZstdDecompressor()
+        if self.frames is None:
+            # Not written by us, decompress as a single stream
+            assert self.start == 0, "Files without a seek table can not be sought"
+            self.f.seek(0)
+            reader = decompressor.stream_reader(self.f, read_across_frames=True)
+            yield from io.TextIOWrapper(reader, encoding="utf-8")
+            return
+        for offset, c_size, d_size in self.frames:
+            if offset < self.start:
+                continue
+            if self.end is not None and offset >= self.end:
+                break
+            self.f.seek(offset)
+            data = decompressor.decompress(self.f.read(c_size), max_output_size=d_size)
+            yield from io.StringIO(data.decode("utf-8"))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_jsonl(path, mode="r"):
+    """Opens a line-delimited JSON file for reading ("r") or writing ("w", "a")
+    text lines. The file is zstd compressed if the path ends with .zst."""
+
+    if is_compressed(path):
+        if mode == "r":
+            return _ZstdReader(path)
+        return _ZstdWriter(path, mode)
+    return open(path, mode, encoding="utf-8")
+
+
+def can_split_jsonl(path):
+    """Returns whether split_jsonl can split the file, i.e. it is a regular
+    file, not a pipe, and it has a seek table if it is compressed."""
+
+    if not os.path.isfile(path):
+        return False
+    if is_compressed(path):
+        if zstandard is None:
+            return False
+        with open(path, "rb") as f:
+            return read_seek_table(f) is not None
+    return True
+
+
+def split_jsonl(path, n_shards):
+    """Splits a file into at most n_shards byte ranges that start at a line, or
+    at a frame for the compressed files. Returns a list of (start, end) tuples
+    that can be read with read_jsonl_range."""
+
+    if is_compressed(path):
+        _check_zstandard()
+        with open(path, "rb") as f:
+            frames = read_seek_table(f)
+        assert frames is not None, f"{path} has no seek table, it can not be split"
+        if not frames:
+            return []
+        data_end = frames[-1][0] + frames[-1][1]
+        starts = [offset for offset, _, _ in frames]
+    else:
+        data_end = os.path.getsize(path)
+        starts = None
+
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n_shards):
+            offset = i * data_end // n_shards
+            if starts is not None:
+                # The first frame that starts after the offset
+                boundary = next((s for s in starts if s >= offset), data_end)
+            elif offset > 0:
+                # The first line that starts at or after the offset
+                f.seek(offset - 1)
+                boundary = offset - 1
+                while True:
+                    block = f.read(READ_SIZE)
+                    if not block:
+                        boundary = data_end
+                        break
+                    newline = block.find(b"\n")
+                    if newline != -1:
+                        boundary += newline + 1
+                        break
+                    boundary += len(block)
+            else:
+                continue
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if data_end > boundaries[-1]:
+        boundaries.append(data_end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_jsonl_range(path, start=0, end=None):
+    """Yields the text lines between the byte offsets start and end. The
+    offsets should come from split_jsonl, or be 0 and None for the whole file."""
+
+    if is_compressed(path):
+        with _ZstdReader(path, start, end) as reader:
+            yield from reader
+        return
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line.decode("utf-8")
@@ -0,0 +1,144 @@
+"""Throughput and resource metrics of the pipeline stages.
+
+If the DISCOGS_VI_METRICS environment variable is set to a file path, each
+stage appends a JSON line to that file every METRICS_INTERVAL seconds and when
+it finishes, e.g.
+
+    DISCOGS_VI_METRICS=metrics.jsonl python discogs_vi/clean_releases.py ...
+
+Each line contains the stage name, the processed records, the input and output
+bytes, their rates per second since the start of the stage, the peak RSS of
+the stage and its worker processes, the number of records dropped by each
+filter of the stage and the estimated time left. The rates and the ETA are
+null when they are not known, e.g. the ETA of a stage reading from a pipe."""
+
+import io
+import os
+import gzip
+import json
+import time
+import resource
+
+METRICS_PATH = os.environ.get("DISCOGS_VI_METRICS")
+
+# Seconds between two metrics lines
+METRICS_INTERVAL = 10
+
+# The clock is checked once every this many records
+CHECK_EVERY = 1000
+
+
+def file_position(f):
+    """Returns the bytes read from or written to the file underlying f, a
+    text or binary file, a compressed jsonl file, a callable returning the
+    position or the position itself. Returns None if the position can not be
+    known, e.g. for pipes."""
+
+    try:
+        if f is None or isinstance(f, int):
+            return f
+        if callable(f):
+            return f()
+        if isinstance(f, io.TextIOWrapper):
+            if f.writable():
+                f.flush()
+            return f.buffer.tell()
+        if isinstance(f, gzip.GzipFile):
+            # Compressed bytes, comparable to the size of the .gz file
+            return f.fileobj.tell()
+        if isinstance(f, io.BufferedIOBase):
+            return f.tell()
+        if isinstance(getattr(f, "f", None), io.IOBase):
+            # Compressed jsonl readers and writers
+            return f.f.tell()
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process and of its finished
+    children, in megabytes."""
+
+    # ru_maxrss is in kilobytes on Linux
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(rss / 1024, 1)
+
+
+class StageMetrics:
+    """Counts the records of a stage and writes its metrics lines. in_f and
+    out_f are used for the byte counts, see file_position. input_path is the
+    input file, its size is used for the ETA. drops maps the name of each
+    filtering function of the stage to a dict of the number of records it
+    dropped for each reason, which the stage keeps up to date."""
+
+    def __init__(self, stage, input_path=None, in_f=None, out_f=None, drops=None):
+        self.stage = stage
+        self.in_f = in_f
+        self.out_f = out_f
+        self.drops = drops if drops is not None else {}
+        self.input_size = None
+        if input_path is not None and os.path.isfile(input_path):
+            self.input_size = os.path.getsize(input_path)
+        self.records = 0
+        self.start_time = time.monotonic()
+        self.next_emit = self.start_time + METRICS_INTERVAL
+
+    def step(self, n=1):
+        """Counts n processed records and writes a metrics line if it is time."""
+
+        self.records += n
+        if METRICS_PATH is None or self.records % CHECK_EVERY >= n:
+            return
+        if time.monotonic() >= self.next_emit:
+            self.emit()
+
+    def emit(self, final=False):
+        if METRICS_PATH is None:
+            return
+
+        now = time.monotonic()
+        elapsed = now - self.start_time
+        input_bytes = file_position(self.in_f)
+        output_bytes = file_position(self.out_f)
+        if final and input_bytes is None:
+            # The whole input was read
+            input_bytes = self.input_size
+
+        def rate(count):
+            if count is None or elapsed <= 0:
+                return None
+            return round(count / elapsed, 1)
+
+        eta = None
+        if final:
+            eta = 0
+        elif input_bytes and self.input_size:
+            eta = round((self.input_size - input_bytes) * elapsed / input_bytes, 1)
+
+        metrics = {
+            "stage": self.stage,
+            "pid": os.getpid(),
+            "time": time.time(),
+            "elapsed_s": round(elapsed, 3),
+            "records": self.records,
+            "records_per_s": rate(self.records),
+            "input_bytes": input_bytes,
+            "input_bytes_per_s": rate(input_bytes),
+            "output_bytes": output_bytes,
+            "output_bytes_per_s": rate(output_bytes),
+            "peak_rss_mb": peak_rss_mb(),
+            "drops": {name: dict(counts) for name, counts in self.drops.items()},
+            "eta_s": eta,
+            "final": final,
+        }
+        with open(METRICS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(metrics) + "\n")
+        self.next_emit = now + METRICS_INTERVAL
+
+    def close(self):
+        """Writes the final metrics line of the stage."""
+        self.emit(final=True)
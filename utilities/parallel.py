@@ -0,0 +1,67 @@
+"""Processing the lines of a line-delimited JSON file with a pool of worker
+processes, as clean_releases.py and parse_releases_to_tracks.py do with
+--workers. The lines are sent to the workers in chunks and the results come
+back in the input order, so the outputs are the same as with a single
+process.
+
+If the file can be split, see jsonl_io.split_jsonl, the chunks are byte
+ranges that each worker reads, and decompresses, by itself. Otherwise, e.g.
+for a pipe, this process reads the lines and sends them to the workers."""
+
+import os
+import sys
+from itertools import islice
+from multiprocessing import Pool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.jsonl_io import can_split_jsonl, split_jsonl, read_jsonl_range
+
+# Lines sent to a worker at a time, if the file can not be split
+CHUNK_SIZE = 2000
+
+# Bytes of the file read by a worker at a time, compressed for .zst files
+CHUNK_BYTES = 2**22
+
+# Records between the progress prints of the stages
+PROGRESS_EVERY = 500000
+
+
+def run_range(task):
+    """Reads the lines of a byte range in a worker and runs the function of
+    the task on them."""
+
+    function, path, start, end = task
+    return function(list(read_jsonl_range(path, start, end)))
+
+
+def imap_chunks(
+    in_f, function, workers, initializer=None, initargs=(), path=None, metrics=None
+):
+    """Yields function(lines) for each chunk of lines of in_f, in the input
+    order, computed by a pool of workers. initializer(*initargs) is called once
+    in each worker to keep what is the same for all the chunks, e.g. the artist
+    ids, instead of sending it with every chunk. With fork the workers share
+    the memory of the parent. If path, the path of in_f, can be split, the
+    workers read the chunks from it instead. The input position of metrics, a
+    StageMetrics, follows the chunks."""
+
+    with Pool(workers, initializer, initargs) as pool:
+        if path is None or not can_split_jsonl(path):
+            chunks = iter(lambda: list(islice(in_f, CHUNK_SIZE)), [])
+            yield from pool.imap(function, chunks)
+            return
+        n_chunks = max(workers, os.path.getsize(path) // CHUNK_BYTES)
+        ranges = split_jsonl(path, n_chunks)
+        tasks = [(function, path, start, end) for start, end in ranges]
+        for (_, end), result in zip(ranges, pool.imap(run_range, tasks)):
+            if metrics is not None:
+                metrics.in_f = end
+            yield result
+
+
+def progress_steps(total, n, every=PROGRESS_EVERY):
+    """Returns the multiples of every passed when n records are added to
+    total, to print the progress of a chunk as if its records were counted one
+    by one."""
+
+    return range(total // every * every + every, total + n + 1, every)
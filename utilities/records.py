@@ -0,0 +1,308 @@
+"""Record types of the pipeline: releases, tracks, versions and cliques, and
+the normalized tracks and their release table rows.
+
+The records keep their fields in __slots__ instead of a dict per object, which
+takes a fraction of the memory of a dict with the same keys, e.g. the tracks
+that clique_finder.py keeps in memory. They can be read and written like the
+dicts they replace, record["track_title"] or record.track_title, so the
+functions that take tracks work with both.
+
+from_dict builds a record only if the keys of the dict are the fields of the
+record, in the same order, optionally followed by its optional fields. Any
+other dict is returned as it is, so that encoding a record gives the same JSON
+as the dict it was built from. json_codec.dumps encodes the records with
+to_dict, e.g.
+
+    track = Track.from_dict(loads(jsonline))
+    dumps(track) == jsonline"""
+
+
+class Record:
+    """Base class of the records. fields are the keys of the JSON object in
+    order and optional the fields that may follow them."""
+
+    __slots__ = ()
+    fields = ()
+    optional = ()
+
+    def __init__(self, **values):
+        missing = [name for name in self.fields if name not in values]
+        extra = [name for name in values if name not in self.fields]
+        if missing or extra:
+            raise TypeError(
+                f"{type(self).__name__} got missing fields {missing} and "
+                f"unexpected fields {extra}"
+            )
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Returns the record of the dict, or the dict if its keys are not
+        the fields of the record."""
+
+        keys = tuple(dct)
+        if keys[: len(cls.fields)] != cls.fields:
+            return dct
+        if keys[len(cls.fields) :] not in cls._optional_keys:
+            return dct
+        record = cls.__new__(cls)
+        for name, value in zip(keys, dct.values()):
+            setattr(record, name, value)
+        return record
+
+    def to_dict(self):
+        """Returns the dict of the record with the keys in JSON order."""
+
+        dct = {name: getattr(self, name) for name in self.fields}
+        for name in self.optional:
+            if hasattr(self, name):
+                dct[name] = getattr(self, name)
+        return dct
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        # The optional fields that may follow the fields, in order
+        cls._optional_keys = {
+            tuple(name for i, name in enumerate(cls.optional) if mask >> i & 1)
+            for mask in range(2 ** len(cls.optional))
+        }
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Track(Record):
+    """A track as written by parse_releases_to_tracks.py."""
+
+    fields = (
+        "track_title",
+        "release_title",
+        "track_writer_ids",
+        "track_writer_names",
+        "track_artist_ids",
+        "track_artist_names",
+        "track_feat_ids",
+        "track_feat_names",
+        "release_id",
+        "release_artist_ids",
+        "release_artist_names",
+        "release_writer_ids",
+        "release_writer_names",
+        "release_feat_ids",
+        "release_feat_names",
+        "release_genres",
+        "release_styles",
+        "country",
+        "labels",
+        "formats",
+        "master_id",
+        "main_release",
+        "release_videos",
+        "released",
+        "track_title_cleaned",
+    )
+    # Added by search_tracks_in_queried_yt_metadata.py
+    optional = ("youtube_video",)
+    __slots__ = fields + optional
+
+    # Fields with the same value in all the tracks of a release
+    release_fields = (
+        "release_title",
+        "release_id",
+        "release_artist_ids",
+        "release_artist_names",
+        "release_writer_ids",
+        "release_writer_names",
+        "release_feat_ids",
+        "release_feat_names",
+        "release_genres",
+        "release_styles",
+        "country",
+        "labels",
+        "formats",
+        "master_id",
+        "main_release",
+        "release_videos",
+        "released",
+    )
+
+    def share_release(self, other):
+        """Replaces the release fields of the track with the equal values of
+        other, e.g. the previous track of the same release, so that they are
+        kept in memory once per release instead of once per track."""
+
+        if self.release_id != other.release_id:
+            return
+        for name in self.release_fields:
+            value = getattr(other, name)
+            if getattr(self, name) == value:
+                setattr(self, name, value)
+
+
+class ReleaseRow(Record):
+    """A row of the release table of the normalized tracks: the release
+    fields of Track, which are the same for all the tracks of a release."""
+
+    fields = ("release_id",) + tuple(
+        name for name in Track.release_fields if name != "release_id"
+    )
+    __slots__ = fields
+
+    @classmethod
+    def from_track(cls, track):
+        """Returns the ReleaseRow of the release of a Track."""
+
+        row = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(row, name, track[name])
+        return row
+
+
+class NormalizedTrack(Record):
+    """A track of the normalized output of parse_releases_to_tracks.py: the
+    fields of Track that are not release fields, and the release_id. If the
+    track has a release table, set by ReleaseTable.track, the release fields
+    are looked up in it when they are read, e.g. track["release_artist_ids"],
+    but they are not written back."""
+
+    fields = (
+        "track_title",
+        "track_writer_ids",
+        "track_writer_names",
+        "track_artist_ids",
+        "track_artist_names",
+        "track_feat_ids",
+        "track_feat_names",
+        "release_id",
+        "track_title_cleaned",
+    )
+    optional = Track.optional
+    __slots__ = fields + optional + ("releases",)
+
+    @classmethod
+    def from_track(cls, track):
+        """Returns the NormalizedTrack of a Track."""
+
+        normalized = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(normalized, name, track[name])
+        return normalized
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            if key in ReleaseRow.fields and hasattr(self, "releases"):
+                return self.releases[self.release_id][key]
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def join(self):
+        """Returns the Track with the fields of its release."""
+
+        track = Track.__new__(Track)
+        for name in Track.fields + Track.optional:
+            if name in self:
+                setattr(track, name, self[name])
+        return track
+
+
+class Version(Record):
+    """A version of a clique, with its tracks."""
+
+    fields = ("version_id", "tracks")
+    optional = ("youtube_video",)
+    __slots__ = fields + optional
+
+    @classmethod
+    def from_dict(cls, dct, releases=None):
+        """Returns the Version of the dict. With releases, a ReleaseTable,
+        the normalized tracks are joined to it."""
+
+        version = super().from_dict(dct)
+        track = Track.from_dict if releases is None else releases.track
+        version["tracks"] = list(map(track, version["tracks"]))
+        return version
+
+
+class Clique(Record):
+    """A clique of versions as written by clique_finder.py."""
+
+    fields = ("clique_id", "versions")
+    __slots__ = fields
+
+    @classmethod
+    def from_dict(cls, dct, releases=None):
+        """Returns the Clique of the dict. With releases, a ReleaseTable,
+        the normalized tracks are joined to it."""
+
+        clique = super().from_dict(dct)
+        clique["versions"] = [
+            Version.from_dict(version, releases) for version in clique["versions"]
+        ]
+        return clique
+
+
+class Release(Record):
+    """The fields of a clean release that parse_releases_to_tracks.py uses.
+    The clean releases have more fields, in varying order, so it is built with
+    from_release and is not written back."""
+
+    fields = (
+        "id",
+        "title",
+        "artists",
+        "extraartists",
+        "tracklist",
+        "genres",
+        "styles",
+        "country",
+        "labels",
+        "formats",
+        "master_id",
+        "main_release",
+        "videos",
+        "released",
+    )
+    __slots__ = fields
+
+    @classmethod
+    def from_release(cls, release):
+        """Returns the Release of a clean release dict."""
+        record = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(record, name, release[name])
+        return record
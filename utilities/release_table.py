@@ -0,0 +1,87 @@
+"""Release table of the normalized tracks.
+
+With --normalize, parse_releases_to_tracks.py writes each track with its track
+fields and its release_id only, as NormalizedTrack records, and the fields of
+each release once, in a release table next to the tracks file, e.g.
+
+    discogs_20240701_releases.xml.jsonl.clean.tracks
+    discogs_20240701_releases.xml.jsonl.clean.tracks.releases
+
+clique_finder.py keeps the cliques normalized and writes the table of the
+releases of their tracks next to the cliques file. The scripts that read the
+tracks or the cliques load the table next to their input file, if there is one,
+and read the release fields of each track from it when they are needed.
+post_processing.py joins the release fields to the tracks of the final dataset
+with join_releases, so that it has no release table."""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.jsonl_io import open_jsonl, add_suffix
+from utilities.json_codec import loads, dumps
+from utilities.records import Track, NormalizedTrack, ReleaseRow
+
+
+def get_release_table_path(path):
+    """Returns the path of the release table of a tracks or cliques file."""
+    return add_suffix(path, ".releases")
+
+
+class ReleaseTable(dict):
+    """ReleaseRow records keyed by release_id."""
+
+    @classmethod
+    def load(cls, path):
+        """Reads a release table file."""
+
+        table = cls()
+        with open_jsonl(path) as in_f:
+            for jsonline in in_f:
+                row = ReleaseRow.from_dict(loads(jsonline))
+                table[row["release_id"]] = row
+        return table
+
+    def track(self, dct):
+        """Returns the NormalizedTrack of a track dict, which reads its release
+        fields from this table. Tracks that are not normalized are returned as
+        Track.from_dict does."""
+
+        track = NormalizedTrack.from_dict(dct)
+        if type(track) is not NormalizedTrack:
+            return Track.from_dict(dct)
+        track.releases = self
+        return track
+
+    def save(self, path, release_ids=None):
+        """Writes the rows of release_ids, all by default, to a release table
+        file. The ids that are not in the table are skipped."""
+
+        with open_jsonl(path, "w") as out_f:
+            for release_id in self if release_ids is None else release_ids:
+                if release_id in self:
+                    out_f.write(dumps(self[release_id]) + "\n")
+
+
+def load_release_table(path):
+    """Loads the release table next to a tracks or cliques file. Returns None
+    if there is none, i.e. the tracks are not normalized."""
+
+    table_path = get_release_table_path(path)
+    if not os.path.isfile(table_path):
+        return None
+    print(f"Loading the release table {table_path}")
+    return ReleaseTable.load(table_path)
+
+
+def join_releases(clique):
+    """Replaces the normalized tracks of a clique, as read by Clique.from_dict
+    with a release table, with Tracks that have all the fields of their
+    release. Returns the clique."""
+
+    for version in clique["versions"]:
+        version["tracks"] = [
+            track.join() if isinstance(track, NormalizedTrack) else track
+            for track in version["tracks"]
+        ]
+    return clique
@@ -1,7 +1,13 @@
+import os
 import re
 import unicodedata
+from functools import lru_cache
+from collections import Counter
+
 import unidecode
 
+from utilities.records import Record
+
 ##################################### Artist Relations #####################################
 
 
@@ -50,6 +56,32 @@ def collect_all_related_artists(total_artist_ids, artist_id, artists_dict):
                 total_artist_ids.update(artists_dict[namevar_id].get("aliases", []))
 
 
+class RelatedArtistsIndex(dict):
+    """Cache of the related artists of each artist, as collected by
+    collect_all_related_artists, stored as frozensets keyed by artist id. Each
+    closure is computed once, the first time it is looked up, or read from the
+    closures of the artist graph if it has them, see
+    utilities.artist_graph.related_closures. It can be passed to
+    collect_performance_artists and collect_writer_artists in place of the
+    artists dictionary. The cache is not bounded: it holds the closure of
+    every artist it has seen for as long as the index lives, which is one
+    call when read_tracks creates it."""
+
+    def __init__(self, artists_dict):
+        super().__init__()
+        self.artists_dict = artists_dict
+
+    def __missing__(self, artist_id):
+        if getattr(self.artists_dict, "closures", None) is not None:
+            closure = frozenset(self.artists_dict.related_artists(artist_id))
+        else:
+            artist_ids = set()
+            collect_all_related_artists(artist_ids, artist_id, self.artists_dict)
+            closure = frozenset(artist_ids)
+        self[artist_id] = closure
+        return closure
+
+
 def collect_performance_artists(track, artists_dict):
     """Collects all the relevant artist ids for a track or a list of tracks.
     If for a given track, artist_ids are not available, it uses the release
@@ -59,7 +91,7 @@ def collect_performance_artists(track, artists_dict):
     their aliases."""
 
     # If a single track is given get its artists
-    if type(track) is dict:
+    if type(track) is dict or isinstance(track, Record):
         # Determine which ID to use
         if track["track_artist_ids"] != []:
             ids = set(track["track_artist_ids"])
@@ -70,6 +102,8 @@ def collect_performance_artists(track, artists_dict):
 
         # Collect the IDs for all artists, their aliases and group members
         artist_ids = set()
+        if isinstance(artists_dict, RelatedArtistsIndex):
+            return artist_ids.union(*map(artists_dict.__getitem__, ids))
         for id in ids:
             # Get the related artist ids
             collect_all_related_artists(artist_ids, id, artists_dict)
@@ -83,7 +117,7 @@ def collect_performance_artists(track, artists_dict):
         return artist_ids
     else:
         raise TypeError(
-            f"track must be a dict or a list of dicts, \
+            f"track must be a dict, a Record or a list of them, \
                         not {type(track)}"
         )
 
@@ -95,11 +129,13 @@ def collect_writer_artists(track, artists_dict):
     their aliases."""
 
     # If a single track is given get its artists
-    if type(track) is dict:
+    if type(track) is dict or isinstance(track, Record):
         ids = set(track["track_writer_ids"])
 
         # Collect the IDs for all artists, their aliases and group members
         artist_ids = set()
+        if isinstance(artists_dict, RelatedArtistsIndex):
+            return artist_ids.union(*map(artists_dict.__getitem__, ids))
         for id in ids:
             # Get the related artist ids
             collect_all_related_artists(artist_ids, id, artists_dict)
@@ -113,35 +149,104 @@ def collect_writer_artists(track, artists_dict):
         return artist_ids
     else:
         raise TypeError(
-            f"track must be a dict or a list of dicts, \
+            f"track must be a dict, a Record or a list of them, \
                         not {type(track)}"
         )
 
 
 ##################################### Text Cleaning Methods #####################################
 
+# Results kept by each memoized text cleaning function, the least recently used
+# are evicted first. Can be set with the DISCOGS_VI_TEXT_CACHE environment
+# variable, 0 disables the caches.
+TEXT_CACHE_SIZE = int(os.environ.get("DISCOGS_VI_TEXT_CACHE", 2**16))
+
+# The functions decorated with memoize_text
+MEMOIZED_TEXT_FUNCTIONS = []
+
+
+def memoize_text(function):
+    """Decorator that caches the results of a text cleaning function of one
+    string in a bounded LRU cache of TEXT_CACHE_SIZE strings. The same names and
+    titles are cleaned many times. The hits and misses are printed by
+    print_text_cache_stats."""
+
+    cached = lru_cache(maxsize=TEXT_CACHE_SIZE)(function)
+    MEMOIZED_TEXT_FUNCTIONS.append(cached)
+    return cached
+
+
+def text_cache_counts():
+    """Returns a Counter with the hits and the misses of the cache of each
+    memoized function in this process, keyed by (name, "hits") and
+    (name, "misses"). The counts of several processes can be added."""
+
+    counts = Counter()
+    for function in MEMOIZED_TEXT_FUNCTIONS:
+        hits, misses, _, _ = function.cache_info()
+        counts[function.__name__, "hits"] = hits
+        counts[function.__name__, "misses"] = misses
+    return counts
+
+
+def print_text_cache_stats(counts=None):
+    """Prints the hit rate of the cache of each memoized function that was
+    called, with the counts of text_cache_counts, by default those of this
+    process."""
+
+    if counts is None:
+        counts = text_cache_counts()
+    for function in MEMOIZED_TEXT_FUNCTIONS:
+        hits = counts[function.__name__, "hits"]
+        calls = hits + counts[function.__name__, "misses"]
+        if calls:
+            print(
+                f"{function.__name__:>24}: {hits / calls:>7.2%} cache hits "
+                f"in {calls:>11,} calls."
+            )
+
+
+# Unicode ranges for Basic Latin and Latin-1 Supplement, Latin Extended-A, and more.
+# This covers the basic alphabet and extended characters with diacritics.
+LATIN_RANGES = [
+    (0x0041, 0x005A),  # Basic Latin uppercase A-Z
+    (0x0061, 0x007A),  # Basic Latin lowercase a-z
+    (0x00C0, 0x00D6),  # Latin-1 Supplement uppercase A-O with diacritics
+    (
+        0x00D8,
+        0x00F6,
+    ),  # Latin-1 Supplement uppercase O with diacritics and lowercase o-y
+    (0x00F8, 0x00FF),  # Latin-1 Supplement lowercase o-y with diacritics
+    (0x0100, 0x017F),  # Latin Extended-A
+    (0x0180, 0x024F),  # Latin Extended-B
+    # Additional ranges can be added for Latin Extended Additional, etc.
+]
+
+# Latin letters that unidecode changes, mapped to their unidecode, for str.translate
+LATIN_DIACRITICS_TABLE = {
+    code_point: unidecode.unidecode(chr(code_point))
+    for start, end in LATIN_RANGES
+    for code_point in range(start, end + 1)
+    if unicodedata.category(chr(code_point)).startswith("L")
+    and unidecode.unidecode(chr(code_point)) != chr(code_point)
+}
+
+# Dashes and quotes simplified by soft_clean_text, all of them are punctuation
+DASHES = "―－‐‑‒–—﹘﹣⁃"
+QUOTES = '"‘’“”‚„‛‟'
+SOFT_CLEAN_TABLE = {
+    **LATIN_DIACRITICS_TABLE,
+    **{ord(char): "-" for char in DASHES},
+    **{ord(char): "'" for char in QUOTES},
+}
+
 
 def is_latin_character(char):
-    # Unicode ranges for Basic Latin and Latin-1 Supplement, Latin Extended-A, and more.
-    # This covers the basic alphabet and extended characters with diacritics.
-    latin_ranges = [
-        (0x0041, 0x005A),  # Basic Latin uppercase A-Z
-        (0x0061, 0x007A),  # Basic Latin lowercase a-z
-        (0x00C0, 0x00D6),  # Latin-1 Supplement uppercase A-O with diacritics
-        (
-            0x00D8,
-            0x00F6,
-        ),  # Latin-1 Supplement uppercase O with diacritics and lowercase o-y
-        (0x00F8, 0x00FF),  # Latin-1 Supplement lowercase o-y with diacritics
-        (0x0100, 0x017F),  # Latin Extended-A
-        (0x0180, 0x024F),  # Latin Extended-B
-        # Additional ranges can be added for Latin Extended Additional, etc.
-    ]
 
     code_point = ord(char)  # Get the Unicode code point of the character
 
     # Check if the character falls within any of the Latin ranges
-    for start, end in latin_ranges:
+    for start, end in LATIN_RANGES:
         if start <= code_point <= end:
             return True
 
@@ -153,15 +258,13 @@ def remove_latin_diacritics(text):
     """Removes diacritics from Latin characters but do not alter other characters.
     Returns the text without diacritics."""
 
-    result = []
-    for char in text:
-        # If the character is a Latin letter with a diacritic, remove the diacritic
-        if unicodedata.category(char).startswith("L") and is_latin_character(char):
-            char = unidecode.unidecode(char)
-        result.append(char)
-    return "".join(result)
+    # Nothing to remove from ASCII text
+    if text.isascii():
+        return text
+    return text.translate(LATIN_DIACRITICS_TABLE)
 
 
+@memoize_text
 def clean_parentheses(text):
 
     # Remove all parentheses and their content
@@ -170,6 +273,7 @@ def clean_parentheses(text):
     return text
 
 
+@memoize_text
 def hard_clean_text(text):
     """Cleans the text from unnecessary information. Returns the cleaned text."""
 
@@ -198,6 +302,7 @@ def hard_clean_text(text):
     return text
 
 
+@memoize_text
 def soft_clean_text(text):
     """Cleans the text from unnecessary information. Returns the cleaned text."""
 
@@ -210,25 +315,7 @@ def soft_clean_text(text):
     # Replace & with and
     text = re.sub(r"\s&\s", " and ", text)
 
-    result = []
-    for char in text:
-        category = unicodedata.category(char)
-        if category.startswith("L"):  # Check if it's a letter
-            if is_latin_character(char):
-                decoded = unidecode.unidecode(char)
-                result.append(decoded)
-            else:
-                # We do not process the non-latin characters
-                result.append(char)
-        elif category.startswith("P"):  # Punctuation
-            # Simplify the punctuation
-            # Replace all dashes with a single dash
-            char = re.sub(r"[―－‐‑‒–—﹘﹘﹣⁃]", "-", char)
-            # Replace all quotes with a single quote
-            char = re.sub(r'["‘’“”‚„‛‟]', "'", char)
-            result.append(char)
-        else:
-            result.append(char)
-        # else: # Remove
-        #     continue # TODO ??
-    return "".join(result)
+    # Remove the diacritics of Latin letters and simplify the dashes and quotes
+    if text.isascii():
+        return text.replace('"', "'")
+    return text.translate(SOFT_CLEAN_TABLE)